@@ -1,10 +1,32 @@
+from .BaseReader import BaseReader
 from .FileReader import TempFileReader
 from tkinter import *
 from . import grailutil
+from . import protocols
+import io
 import os
+import threading
+import time
+from collections import deque
 
 TkPhotoImage = PhotoImage
 
+# Images are decoded and scaled by PIL on this many worker threads
+DECODE_WORKERS = 2
+DECODE_POLL = 20                        # Milliseconds between checks
+PREVIEW_INTERVAL = 0.5                  # Seconds between partial images
+
+_executor = None
+
+
+def get_decoder():
+    """Return the thread pool that decodes images."""
+    global _executor
+    if _executor is None:
+        from concurrent.futures import ThreadPoolExecutor
+        _executor = ThreadPoolExecutor(DECODE_WORKERS)
+    return _executor
+
 
 class ImageTempFileReader(TempFileReader):
 
@@ -43,20 +65,6 @@ class ImageTempFileReader(TempFileReader):
         self.cleanup()
 
     def handle_error(self, errcode, errmsg, headers):
-        if errcode == 401:
-            if 'www-authenticate' in headers:
-                cred_headers = {}
-                for k, v in headers.items():
-                    cred_headers[k.lower()] = v
-                cred_headers['request-uri'] = self.image.url
-                self.stop()
-                credentials = self.image.context.app.auth.request_credentials(
-                    cred_headers)
-                if 'Authorization' in credentials:
-                    for k, v in credentials.items():
-                        self.image.headers[k] = v
-                    # self.image.restart(self.image.url)
-                    self.image.start_loading(self.image.context)
         self.image.set_error(errcode, errmsg, headers)
         self.cleanup()
 
@@ -74,8 +82,131 @@ class ImageTempFileReader(TempFileReader):
             pass
 
 
+class ImageDataReader(BaseReader):
+
+    """Stream image data straight into a PIL decoder.
+
+    Only used with PIL, which needs no external filters; the data
+    never goes through a temporary file.
+    """
+
+    def __init__(self, context, api, image):
+        self.image = image
+        self.url = self.image.url
+        self.decoder = image.make_decoder()
+        BaseReader.__init__(self, context, api)
+
+    def handle_data(self, data):
+        self.decoder.feed(data)
+        self.image.update_preview(self.decoder)
+
+    def handle_eof(self):
+        decoder, image = self.decoder, self.image
+        self.decoder = self.image = None
+        image.reader = None
+        image.set_stream(decoder)
+
+    def handle_error(self, errcode, errmsg, headers):
+        self.image.set_error(errcode, errmsg, headers)
+        self.image = None
+
+    def stop(self):
+        BaseReader.stop(self)
+        if self.decoder:
+            self.decoder.cancel()
+            self.decoder = None
+        if self.image:
+            self.image.reader = None
+
+
+class StreamDecoder:
+
+    """Feed image data to a PIL ImageFile.Parser on the decoder threads.
+
+    The main thread queues the data as it arrives; the worker threads
+    feed it to the parser in order, so decoding keeps up with the
+    download instead of starting when it is done.  While it does, the
+    partly decoded image can be had from preview().
+
+    A JPEG image that is to be shown at a given size is only collected
+    instead; decode_image() can then decode it at a reduced scale,
+    which the parser cannot.
+    """
+
+    def __init__(self, width=0, height=0):
+        from PIL import ImageFile
+        self.parser = ImageFile.Parser()
+        self.width = width
+        self.height = height
+        self.buffer = None
+        self.started = False
+        self.chunks = deque()
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.error = None
+
+    def feed(self, data):
+        if not self.started:
+            self.started = True
+            if (self.width or self.height) and data[:2] == b'\xff\xd8':
+                self.buffer = bytearray()
+        if self.buffer is not None:
+            self.buffer.extend(data)
+            return
+        self.chunks.append(data)
+        get_decoder().submit(self.drain)
+
+    def preview(self, width, height, rgb):
+        """Return a future for a prepare_image() of the partial image."""
+        return get_decoder().submit(self.make_preview, width, height, rgb)
+
+    def close(self, width, height, rgb):
+        """Return a future for the result of prepare_image()."""
+        return get_decoder().submit(self.finish, width, height, rgb)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    # These run on the decoder threads
+
+    def drain(self):
+        with self.lock:
+            while self.chunks:
+                data = self.chunks.popleft()
+                if self.error or self.cancelled.is_set():
+                    continue
+                try:
+                    self.parser.feed(data)
+                except (IOError, ValueError) as err:
+                    self.error = err
+
+    def make_preview(self, width, height, rgb):
+        with self.lock:
+            # only images that PIL decodes as the data arrives
+            im = self.parser.image
+            if im is None or self.parser.decoder is None:
+                return None
+            im = im.copy()
+        return prepare_image(im, width, height, rgb, self.cancelled)
+
+    def finish(self, width, height, rgb):
+        if self.buffer is not None:
+            return decode_image(io.BytesIO(self.buffer), width, height, rgb,
+                                self.cancelled)
+        self.drain()
+        with self.lock:
+            if self.error:
+                raise self.error
+            if self.cancelled.is_set():
+                return None
+            im = self.parser.close()
+        return prepare_image(im, width, height, rgb, self.cancelled)
+
+
 class BaseAsyncImage:
 
+    decoding = None                     # Set while decoded in the background
+
     def setup(self, context, url, reload):
         self.context = context
         self.url = url
@@ -89,6 +220,8 @@ class BaseAsyncImage:
             self.start_loading(context)
             if self.reader:
                 self.reader.geteverything()
+            if self.decoding:
+                self.finish_decoding()
         return self.loaded
 
     def start_loading(self, context=None, reload=False):
@@ -96,8 +229,9 @@ class BaseAsyncImage:
         # you had stopped loading
         if context:
             self.context = context
-        if self.reader:
+        if self.reader or self.decoding:
             return
+        self.headers['.priority'] = self.get_priority()
         try:
             api = self.context.app.open_url(self.url, 'GET', self.headers,
                                             self.reload or reload)
@@ -105,20 +239,39 @@ class BaseAsyncImage:
             self.show_bad()
             return
         cached_file, content_type = api.tk_img_access()
-        if cached_file \
-           and ImageTempFileReader.image_filters.get(content_type) == '':
+        if cached_file and self.can_read_file(content_type):
             api.close()
             self.set_file(cached_file)
         else:
             self.show_busy()
-            # even if the item is in the cache, use the ImageTempFile
-            # to handle the proper type coercion
-            self.reader = ImageTempFileReader(self.context, api, self)
+            self.reader = self.make_reader(api)
+
+    def can_read_file(self, content_type):
+        return ImageTempFileReader.image_filters.get(content_type) == ''
+
+    def make_reader(self, api):
+        # even if the item is in the cache, use the ImageTempFile
+        # to handle the proper type coercion
+        return ImageTempFileReader(self.context, api, self)
+
+    def get_priority(self):
+        # images are inserted at the end of the text as it is parsed;
+        # those that will be scrolled out of sight can wait
+        try:
+            visible = self.context.viewer.text.bbox('end - 1 char')
+        except (AttributeError, TclError):
+            visible = True
+        if visible:
+            return protocols.PRIORITY_IMAGE
+        return protocols.PRIORITY_OFFSCREEN
 
     def stop_loading(self):
-        if not self.reader:
+        if self.reader:
+            self.reader.kill()
+        elif self.decoding:
+            self.cancel_decoding()
+        else:
             return
-        self.reader.kill()
         self.show_bad()
 
     def set_file(self, filename):
@@ -136,6 +289,17 @@ class BaseAsyncImage:
                                     self.context.viewer.text["background"])
 
     def set_error(self, errcode, errmsg, headers):
+        if errcode == 401 and 'www-authenticate' in headers:
+            cred_headers = {}
+            for k, v in headers.items():
+                cred_headers[k.lower()] = v
+            cred_headers['request-uri'] = self.url
+            credentials = self.context.app.auth.request_credentials(
+                cred_headers)
+            if 'Authorization' in credentials:
+                for k, v in credentials.items():
+                    self.headers[k] = v
+                self.start_loading(self.context)
         self.loaded = False
         if errcode in (301, 302) and 'location' in headers:
             self.url = headers['location']
@@ -145,7 +309,7 @@ class BaseAsyncImage:
         return self.reload and not self.loaded
 
     def get_load_status(self):
-        if self.reader:
+        if self.reader or self.decoding:
             return 'loading'
         else:
             return 'idle'
@@ -186,6 +350,10 @@ class PILAsyncImageSupport(BaseAsyncImage):
     #
     __width = 0
     __height = 0
+    __timer = None
+    __viewer = None
+    __preview = None
+    __previewtime = 0.0
 
     def __init__(self, context, url, reload=False, width=None, height=None,
                  **kw):
@@ -219,45 +387,91 @@ class PILAsyncImageSupport(BaseAsyncImage):
         #
         return self.url, self.__width, self.__height
 
+    def can_read_file(self, content_type):
+        return True
+
+    def make_reader(self, api):
+        return ImageDataReader(self.context, api, self)
+
+    def make_decoder(self):
+        return StreamDecoder(self.__width, self.__height)
+
+    def update_preview(self, decoder):
+        # Show what has been decoded so far, now and then
+        future = self.__preview
+        if future:
+            if not future.done():
+                return
+            self.__preview = None
+            try:
+                result = future.result()
+            except (IOError, ValueError):
+                result = None
+            if result:
+                self.show_image(result[0])
+        elif time.time() - self.__previewtime >= PREVIEW_INTERVAL:
+            self.__previewtime = time.time()
+            self.__preview = decoder.preview(self.__width, self.__height,
+                                             self.get_background())
+
     def set_file(self, filename):
-        from PIL import Image
+        # Decoding, transparency and scaling happen on a worker thread;
+        # only the paste() into the Tk image is left for check_decoding()
         try:
-            im = Image.open(filename)
-            im.load()                   # force loading to catch IOError
+            fp = open(filename, 'rb')
+        except IOError:
+            return self.show_bad()
+        cancelled = threading.Event()
+        future = get_decoder().submit(decode_image, fp, self.__width,
+                                      self.__height, self.get_background(),
+                                      cancelled)
+        self.start_decoding(future, cancelled, fp)
+
+    def set_stream(self, decoder):
+        self.__preview = None
+        future = decoder.close(self.__width, self.__height,
+                               self.get_background())
+        self.start_decoding(future, decoder.cancelled)
+
+    def get_background(self):
+        viewer = self.context.viewer
+        r, g, b = viewer.text.winfo_rgb(viewer.text["background"])
+        return r // 256, g // 256, b // 256     # 8-bit versions
+
+    def start_decoding(self, future, cancelled, fp=None):
+        self.decoding = future, cancelled, fp
+        # Leaving the page drops the decoding
+        viewer = self.context.viewer
+        self.__viewer = viewer
+        viewer.register_reset_interest(self.cancel_decoding)
+        self.__timer = self.context.root.after(DECODE_POLL,
+                                               self.check_decoding)
+
+    def check_decoding(self):
+        self.__timer = None
+        future, cancelled, fp = self.decoding
+        if future.done():
+            self.finish_decoding()
+        else:
+            self.__timer = self.context.root.after(DECODE_POLL,
+                                                   self.check_decoding)
+
+    def finish_decoding(self):
+        """Wait for the decoding to finish and show the image."""
+        future, cancelled, fp = self.decoding
+        self.end_decoding()
+        try:
+            result = future.result()
         except (IOError, ValueError):
             # either of these may occur during decoding...
             return self.show_bad()
-        if im.format == "XBM":
-            im = xbm_to_rgba(im)
-        real_size = im.size
-        # determine desired size:
-        if self.__width and not self.__height and self.__width != im.size[0]:
-            # scale horizontally
-            self.__height = im.size[1] * self.__width // im.size[0]
-        elif self.__height and not self.__width \
-                and self.__height != im.size[1]:
-            # scale vertically
-            self.__width = im.size[0] * self.__height // im.size[1]
-        else:
-            self.__width = self.__width or im.size[0]
-            self.__height = self.__height or im.size[1]
-        # transparency stuff
-        if im.mode == "RGBA" \
-           or (im.mode == "P" and "transparency" in im.info):
-            r, g, b = self.context.viewer.text.winfo_rgb(
-                self.context.viewer.text["background"])
-            r = r // 256                 # convert these to 8-bit versions
-            g = g // 256
-            b = b // 256
-            if im.mode == "P":
-                im = p_to_rgb(im, (r, g, b))
-            else:
-                im = rgba_to_rgb(im, (r, g, b))
-        #
-        if real_size != (self.__width, self.__height):
-            w, h = real_size
-            if w != self.__width or h != self.__height:
-                im = im.resize((self.__width, self.__height))
+        if result is None:
+            return
+        im, self.__width, self.__height = result
+        self.show_image(im)
+        self.loaded = True
+
+    def show_image(self, im):
         # This appears to be absolutely necessary, but I'm not sure why....
         self._PhotoImage__size = im.size
         self.blank()
@@ -266,6 +480,26 @@ class PILAsyncImageSupport(BaseAsyncImage):
         self.image['width'] = w
         self.image['height'] = h
 
+    def cancel_decoding(self, viewer=None):
+        """Drop a decoding that is under way; the image stays blank."""
+        if not self.decoding:
+            return
+        future, cancelled, fp = self.decoding
+        self.end_decoding()
+        cancelled.set()
+        if future.cancel() and fp:
+            fp.close()
+
+    def end_decoding(self):
+        self.decoding = None
+        if self.__timer:
+            self.context.root.after_cancel(self.__timer)
+            self.__timer = None
+        viewer = self.__viewer
+        self.__viewer = None
+        if viewer and self.cancel_decoding in viewer.reset_interests:
+            viewer.unregister_reset_interest(self.cancel_decoding)
+
     def width(self):
         return self.__width
 
@@ -278,6 +512,78 @@ class PILAsyncImageSupport(BaseAsyncImage):
         self.image[key] = value
 
 
+def decode_image(fp, width, height, rgb, cancelled):
+    """Decode an image file and get it ready to be pasted.
+
+    This runs on a worker thread.  The file is closed when done.
+
+    fp
+        The image file, open for reading.
+
+    width, height
+        The requested size; 0 means the natural size, or in proportion
+        if only one of them is given.
+
+    rgb
+        The RGB-value to use for the transparent areas.
+
+    cancelled
+        A threading.Event; once it is set the work is abandoned.
+
+    Returns an (image, width, height) tuple, or None if cancelled.
+    """
+    from PIL import Image
+    with fp:
+        im = Image.open(fp)
+        width, height = target_size(im.size, width, height)
+        if width < im.size[0] and height < im.size[1]:
+            # let the decoder scale down if it can (JPEG does)
+            im.draft(im.mode, (width, height))
+        im.load()                       # force loading to catch IOError
+    return prepare_image(im, width, height, rgb, cancelled)
+
+
+def target_size(size, width, height):
+    """Return the size to show an image of the given size at."""
+    if width and not height and width != size[0]:
+        # scale horizontally
+        height = max(1, size[1] * width // size[0])
+    elif height and not width and height != size[1]:
+        # scale vertically
+        width = max(1, size[0] * height // size[1])
+    else:
+        width = width or size[0]
+        height = height or size[1]
+    return width, height
+
+
+def prepare_image(im, width, height, rgb, cancelled):
+    """Get a decoded image ready to be pasted; see decode_image()."""
+    if cancelled.is_set():
+        return None
+    if im.format == "XBM":
+        im = xbm_to_rgba(im)
+    width, height = target_size(im.size, width, height)
+    # shrinking by whole factors first is much cheaper than resize()
+    factor = min(im.size[0] // width, im.size[1] // height)
+    if factor >= 2 and im.mode in ("L", "RGB", "RGBA") \
+       and hasattr(im, "reduce"):
+        im = im.reduce(factor)
+    real_size = im.size
+    # transparency stuff
+    if im.mode == "RGBA" \
+       or (im.mode == "P" and "transparency" in im.info):
+        if im.mode == "P":
+            im = p_to_rgb(im, rgb)
+        else:
+            im = rgba_to_rgb(im, rgb)
+    if cancelled.is_set():
+        return None
+    if real_size != (width, height):
+        im = im.resize((width, height))
+    return im, width, height
+
+
 def p_to_rgb(im, rgb):
     """Translate a P-mode image with transparency to an RGB image.
 
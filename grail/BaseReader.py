@@ -1,6 +1,8 @@
 """Base reader class -- read from a URL in the background."""
 
+import select
 import sys
+import time
 from tkinter import *
 import urllib.parse
 from . import grailutil
@@ -9,7 +11,9 @@ from . import grailutil
 # Default tuning parameters
 # BUFSIZE = 8*1024                      # Buffer size for api.getdata()
 BUFSIZE = 512                           # Smaller size for better response
+MAXBUFSIZE = 64 * 1024                  # Limit for growing the buffer size
 SLEEPTIME = 100                         # Milliseconds between regular checks
+TIMEBUDGET = 16                         # Milliseconds of reading per check
 
 
 class BaseReader:
@@ -31,6 +35,8 @@ class BaseReader:
 
     # Tuning parameters
     sleeptime = SLEEPTIME
+    timebudget = TIMEBUDGET
+    maxbufsize = MAXBUFSIZE
 
     def __init__(self, context, api):
         self.context = context
@@ -181,9 +187,32 @@ class BaseReader:
             self.getapimeta()
 
     def checkdata(self):
-        self.message, ready = self.api.polldata()
-        if ready:
+        # Keep reading while more data is at hand, for up to timebudget
+        # milliseconds, so a fast source is not read one buffer per
+        # trip through the event loop
+        deadline = time.perf_counter() + self.timebudget / 1000.0
+        while True:
+            self.message, ready = self.api.polldata()
+            if not ready:
+                break
             self.getapidata()
+            if self.callback != self.checkdata \
+               or time.perf_counter() >= deadline \
+               or not self.moredata():
+                break
+
+    def moredata(self):
+        # Some protocols report ready and then block in getdata(), so
+        # only go on without waiting if the socket has data for us.
+        # Ask the api for its socket every time: once the response has
+        # been read, the one we started with may be closed or reused.
+        fno = self.api.fileno() if self.api else -1
+        if fno < 0:
+            return True                 # nothing to block on
+        try:
+            return bool(select.select([fno], [], [], 0)[0])
+        except (OSError, ValueError):
+            return True                 # let getdata() find out
 
     def getapimeta(self):
         errcode, errmsg, headers = self.api.getmeta()
@@ -204,6 +233,10 @@ class BaseReader:
             self.handle_eof()
             self.stop()
             return
+        # A full buffer means more is probably waiting: ask for more
+        # next time, so bulk transfers take fewer trips
+        if len(data) >= self.bufsize and self.bufsize < self.maxbufsize:
+            self.bufsize = min(2 * self.bufsize, self.maxbufsize)
         self.update_nbytes(data)
         self.handle_data(data)
 
@@ -234,3 +267,102 @@ class BaseReader:
     def handle_eof(self):
         # Called after self.stop() has been called
         pass
+
+
+def test():
+    """Read a Connection: close response from a local server.
+
+    The body is read through checkdata(), which must see the end of
+    the response without an error even though the connection is
+    closed as soon as the last byte arrives.
+    """
+    import http.server
+    import threading
+    import traceback
+    from .grailbase import utils
+    from .protocols import httpAPI
+
+    body = b'x' * (4 * MAXBUFSIZE + 1)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class Sockets:
+        max = 4
+        open = 0
+
+        def request_socket(self, requestor, callback, host=None,
+                           priority=None):
+            callback()
+
+        def return_socket(self, owner):
+            pass
+
+    class App:
+        root = Tcl()
+        sq = Sockets()
+        errors = []
+
+        def exception_dialog(self, where):
+            traceback.print_exc()
+            self.errors.append(where)
+
+    class Context:
+        app = App()
+        root = app.root
+
+        def addreader(self, reader):
+            pass
+
+        def rmreader(self, reader):
+            pass
+
+        def remove_local_api_handlers(self):
+            pass
+
+        def new_reader_status(self):
+            pass
+
+    class TestReader(BaseReader):
+        data = b''
+        done = False
+
+        def handle_data(self, data):
+            self.data = self.data + data
+
+        def handle_eof(self):
+            self.done = True
+
+        def handle_error(self, errcode, errmsg, headers):
+            self.done = True
+
+    app, utils._grail_app = utils._grail_app, Context.app
+    try:
+        url = '//127.0.0.1:{}/close'.format(server.server_address[1])
+        reader = TestReader(Context(), httpAPI.http_access(url, 'GET', {}))
+        while not reader.done:
+            Context.root.dooneevent()
+        assert not App.errors, App.errors
+        assert reader.data == body, len(reader.data)
+        print("read", len(reader.data), "bytes from", url)
+    finally:
+        utils._grail_app = app
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == '__main__':
+    test()
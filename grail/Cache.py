@@ -28,7 +28,9 @@ class SharedItem:
     retrieve an object.
 
     The disk cache passes an disk_cache_access api which sets some
-    basic headers and starts the object out in the DATA state.
+    basic headers and starts the object out in the DATA state. If the
+    api offers a memoryview of the whole body through getview(), data
+    is served straight from it rather than copied into self.data.
 
     """
 
@@ -46,9 +48,9 @@ class SharedItem:
 
         # status
         self.reloading = False
-        self.data = []
+        self.data = bytearray()
         self.datalen = 0
-        self.datamap = {}
+        self.mapped = None
         self.complete = False
 
         # initialize in one of four states
@@ -76,6 +78,7 @@ class SharedItem:
             self.api = api
             self.meta = api.getmeta()
             self.stage = self.api.state
+            self.use_mapped_data()
 
             # status
             self.incache = True
@@ -142,42 +145,43 @@ class SharedItem:
             msg, ready = "Reading cache", True
         return msg, ready
 
+    def use_mapped_data(self):
+        getview = getattr(self.api, 'getview', None)
+        view = getview() if getview else None
+        if view is not None:
+            self.mapped = view
+            self.datalen = len(view)
+
     def getdata(self, offset, maxbytes):
         assert offset >= 0
         assert maxbytes > 0
 
+        if self.mapped is not None:
+            # the api is kept open until the last reader is done
+            if offset >= self.datalen:
+                self.complete = True
+                return b''
+            return self.mapped[offset:offset + maxbytes].tobytes()
+
+        if self.stage == META:
+            self.meta = self.api.getmeta()
+            self.stage = DATA
+
+        # all data received so far is kept in one buffer, so readers
+        # asking for different chunk sizes can start at any offset
         while self.stage == DATA and offset >= self.datalen:
             buf = self.api.getdata(maxbytes)
             if not buf:
                 self.finish()
                 self.complete = True
             else:
-                l = len(buf)
-                if l > maxbytes:
-                    # we got more than we wanted,
-                    # so split into two strings (avoid search next time)
-                    self.data.append(buf[:maxbytes])
-                    self.datamap[offset] = len(self.data) - 1
-                    self.data.append(buf[maxbytes:])
-                    self.datamap[offset + maxbytes] = len(self.data) - 1
-                else:
-                    self.data.append(buf)
-                    self.datamap[offset] = len(self.data) - 1
-                self.datalen = self.datalen + l
-
-        try:
-            # the common case
-            chunk = self.data[self.datamap[offset]]
-            return chunk[0:maxbytes]
-        except KeyError:
-            if self.stage == META:
-                self.meta = self.api.getmeta()
-                self.stage = DATA
-            elif self.complete and offset >= self.datalen:
-                return b''
-            chunk_key, delta = self._getdata_search_string_list(offset)
-            chunk = self.data[self.datamap[chunk_key]]
-            return chunk[delta:]
+                self.data += buf
+                self.datalen = len(self.data)
+
+        # slice a view so the bytes are copied once; it is released
+        # right away, since the buffer cannot grow while it is exported
+        with memoryview(self.data) as view:
+            return view[offset:offset + maxbytes].tobytes()
 
     def fileno(self):
         if self.api:
@@ -194,30 +198,17 @@ class SharedItem:
             if not (self.meta and self.meta[0] == 200):
                 self.cache.delete(self.key)
         self.stage = DONE
+        self.mapped = None
         api = self.api
         self.api = None
         if api:
             api.close()
 
-    def _getdata_search_string_list(self, offset):
-        # WARNING: this lookup is costly, please avoid
-        # cost is O(k), where k is # of chunks
-        # if you use this a lot, you'll get O(N^2) reads
-        delta = offset
-        chunk_key = None
-        for chunk_offset in self.datamap.keys():
-            if offset > chunk_offset:
-                diff = offset - chunk_offset
-                if diff <= delta:
-                    delta = diff
-                    chunk_key = chunk_offset
-        return chunk_key, delta
-
     def init_new_load(self, stage):
         self.meta = None
-        self.data = []
+        self.data = bytearray()
         self.datalen = 0
-        self.datamap = {}
+        self.mapped = None
         self.stage = stage
         self.complete = False
 
@@ -241,6 +232,7 @@ class SharedItem:
             self.api.close()
             self.api = self.cache_api
             self.meta = self.api.getmeta()
+            self.use_mapped_data()
         # elif errcode == 200:
             # there may be cases when we get an error response that
             # doesn't require us to delete the object (a server busy
@@ -363,5 +355,45 @@ def test():
         api.close()
 
 
+def benchmark(size=8 * 1024 * 1024):
+    """Time two readers with different maxbytes sharing one item."""
+
+    class FakeAPI:
+        state = DATA
+
+        def __init__(self):
+            self.left = size
+
+        def getmeta(self):
+            return 200, "OK", {}
+
+        def getdata(self, maxbytes):
+            n = min(maxbytes, self.left)
+            self.left = self.left - n
+            return b'x' * n
+
+        def close(self):
+            pass
+
+    item = SharedItem("http://www.example.com/", 'GET', {}, None, None,
+                      api=FakeAPI())
+    readers = [[0, 512], [0, 8192 + 7]]
+    t0 = time.time()
+    while readers:
+        for reader in readers[:]:
+            data = item.getdata(*reader)
+            if data:
+                reader[0] = reader[0] + len(data)
+            else:
+                readers.remove(reader)
+    t1 = time.time()
+    print("{} bytes, readers of 512 and 8199 bytes: {:.2f} seconds".format(
+        size, t1 - t0))
+
+
 if __name__ == '__main__':
-    test()
+    import sys
+    if sys.argv[1:2] == ['-b']:
+        benchmark(*map(int, sys.argv[2:3]))
+    else:
+        test()
@@ -5,6 +5,13 @@ import time
 from . import ht_time
 from . import grailutil
 import re
+import io
+import mmap
+import hashlib
+import struct
+import heapq
+import itertools
+from collections import OrderedDict
 from numbers import Real
 
 META, DATA, DONE = 'META', 'DATA', 'DONE'  # Three stages
@@ -88,10 +95,17 @@ class CacheManager:
         if bool:
             self.app.register_on_exit(
                 lambda save=self.save_cache_state: save())
+        else:
+            self.app.register_on_exit(
+                lambda flush=self.flush_cache_logs: flush())
 
     def save_cache_state(self):
         for cache in self.caches:
-            cache._checkpoint_metadata()
+            cache._checkpoint_metadata(incremental=True)
+
+    def flush_cache_logs(self):
+        for cache in self.caches:
+            cache.flush_log()
 
     def update_prefs(self):
         self.set_freshness_test()
@@ -414,15 +428,16 @@ class DiskCacheEntry:
         self.encoding = cencoding
         self.transfer_encoding = ctencoding
 
-    string_date = re.compile('^[A-Za-z]')
-
     def __repr__(self):
         return self.unparse()
 
     def parse(self, parsed_rep):
         """Reads transaction log entry.
         """
-        vars = parsed_rep.split('\t')
+        self.parse_fields(parsed_rep.split('\t'))
+
+    def parse_fields(self, vars):
+        """Fill in the entry from the list of fields of a log entry."""
         self.key = vars[0]
         self.url = vars[1]
         self.file = vars[2]
@@ -444,24 +459,23 @@ class DiskCacheEntry:
             else:
                 if self.transfer_encoding == 'None':
                     self.transfer_encoding = None
-        self.date = None
-        self.lastmod = None
-        self.expires = None
-        for tup in [(vars[4], 'date'), (vars[5], 'lastmod'),
-                    (vars[6], 'expires')]:
-            self.parse_assign(tup[0], tup[1])
+        parse_time = self.parse_time
+        self.date = parse_time(vars[4])
+        self.lastmod = parse_time(vars[5])
+        self.expires = parse_time(vars[6])
 
     def parse_assign(self, rep, var):
+        setattr(self, var, self.parse_time(rep))
+
+    @staticmethod
+    def parse_time(rep):
         if rep == 'None':
-            setattr(self, var, None)
-            return
-        match = self.string_date.match(rep)
-        if match and match.start() == 0:
-            setattr(self, var, HTTime(str=rep))
-        else:
-            setattr(self, var, HTTime(secs=float(rep)))
+            return None
+        if rep[:1].isalpha():
+            return HTTime(str=rep)
+        return HTTime(secs=float(rep))
 
-    def unparse(self):
+    def unparse(self, sep='\t'):
         """Return entry for transaction log.
         """
         if not hasattr(self, 'file'):
@@ -469,7 +483,7 @@ class DiskCacheEntry:
         stuff = [self.key, self.url, self.file, self.size, self.date,
                  self.lastmod, self.expires, self.type, self.encoding,
                  self.transfer_encoding]
-        s = '\t'.join(map(str, stuff))
+        s = sep.join(map(str, stuff))
         return s
 
     def get(self):
@@ -504,7 +518,7 @@ class DiskCacheEntry:
 
 
 def expire_key(item):
-    """used with list.sort() to sort list of CacheEntries by expiry date."""
+    """Return the expiry date of a CacheEntry in seconds since the epoch."""
     return item.expires.get_secs()
 
 
@@ -513,17 +527,31 @@ class DiskCache:
 
     need to discuss:
 
-    use_order
+    use_order: an OrderedDict mapping keys to None, least recently
+    used first. A hit moves the key to the end, so lookup, touch and
+    eviction of the LRU page are all O(1).
 
-    the log: writes every change to cache or use_order, writes
-    flushed, do a checkpoint run on startup, format is tuple (entry
-    type, object), where entry type is add, evict, update use_order,
-    version.
+    the log: writes every change to cache or use_order, do a
+    checkpoint run on startup, format is tuple (entry type, object),
+    where entry type is add, evict, update use_order, version. Since
+    log version 2.0 each entry is a binary record: the entry type as
+    one byte and the length of the object as four bytes, followed by
+    the object; the fields of an added entry are separated by NUL
+    bytes. Adds and evictions are flushed right away, use_order
+    updates are flushed in groups (see log_use_order()).
 
-    expires
+    expires: dictionary mapping keys to the entries that have an
+    explicit expire date. expire_heap is a min-heap of (expiry secs,
+    sequence, entry) tuples over the same entries; entries evicted
+    by LRU are left in the heap and skipped when they surface.
 
     evict
 
+    files: each entry is stored in a file named after the SHA-1 hash
+    of its key, in a two-level fan-out of directories taken from the
+    first four hex digits of the hash (ab/cd/abcd...). Caches written
+    with the old flat layout are moved over when they are opened.
+
     Note: Nowhere do we verify that the disk has enough space for a
     full cache.
 
@@ -541,110 +569,192 @@ class DiskCache:
         self.manager = manager
         self.manager.add_cache(self)
         self.items = {}
-        self.use_order = []
+        self.use_order = OrderedDict()
         self.log = None
-        self.expires = []
+        self.log_records = 0
+        self.log_pending = 0
+        self.log_timer = None
+        self.expires = {}
+        self.expire_heap = []
+        self.expire_seq = itertools.count()
         self.types = {}
 
         grailutil.establish_dir(self.directory)
-        self._read_metadata()
+        current = self._read_metadata()
+        migrated = self._migrate_flat_files()
+        if migrated or not current:
+            # upgrade the log to the current format and file names
+            self._checkpoint_metadata()
         self._reinit_log()
 
-    log_version = "1.3"
-    log_ok_versions = ["1.2", "1.3"]
+    log_version = "2.0"
+    log_ok_versions = ["1.2", "1.3", "2.0"]
+    log_text_versions = ["1.2", "1.3"]
+
+    log_record = struct.Struct('>BI')
+    # group commit of use_order updates
+    log_flush_records = 64
+    log_flush_interval = 5.0
+    # checkpoint only when the log holds this many records per entry
+    log_garbage_ratio = 2
 
     def close(self, log):
         self.manager.delete(self.items.keys(), evict=False)
         if log:
-            self.use_order = []
+            self.use_order = OrderedDict()
             self._checkpoint_metadata()
+        else:
+            self.flush_log()
         del self.items
         del self.expires
+        del self.expire_heap
         self.manager.close_cache(self)
         self.dead = True
 
     def _read_metadata(self):
         """Read the transaction log from the cache directory.
 
-        Reads the pickled log entries and re-creates the cache's
-        current contents and use_order from the log.
+        Reads the log entries and re-creates the cache's current
+        contents and use_order from the log.
 
         A version number is included, but currently we only assert
         that the version number read is the same as the current
         version number.
+
+        Returns true if the log is in the current binary format and
+        new records may be appended to it.
         """
         logpath = os.path.join(self.directory, 'LOG')
         try:
-            log = open(logpath)
+            with open(logpath, 'rb') as log:
+                data = log.read()
         except IOError:
             # now what happens if there is an error here?
-            log = open(logpath, 'w')
+            log = open(logpath, 'wb')
             log.close()
-            return
+            return False
 
-        with log:
-            for line in log:
-                try:
-                    kind = line[0:1]
-                    if kind == '2':  # use update
-                        key = line[2:-1]
-                        self.use_order.remove(key)
-                        self.use_order.append(key)
-                    elif kind == '1':           # delete
-                        key = line[2:-1]
-                        if key in self.items:
-                            self.size = self.size - self.items.pop(key).size
-                            del self.manager.items[key]
-                            self.use_order.remove(key)
-                            assert key not in self.use_order
-                    elif kind == '0':  # add
-                        newentry = DiskCacheEntry(self)
-                        newentry.parse(line[2:-1])
-                        if newentry.key not in self.items:
-                            self.use_order.append(newentry.key)
-                        newentry.cache = self
-                        self.items[newentry.key] = newentry
-                        self.manager.items[newentry.key] = newentry
-                        self.size = self.size + newentry.size
-                    elif kind == '3':  # version (hopefully first)
-                        ver = line[2:-1]
-                        if ver not in self.log_ok_versions:
-                           # clear out anything we might have read
-                           # and bail. this is an old log file.
-                            if len(self.use_order) > 0:
-                                self.use_order = []
-                                for key in self.items.keys():
-                                    del self.manager.items[key]
-                                self.items.clear()
-                                self.size = 0
-                                return
-                        assert ver in self.log_ok_versions
-                except IndexError:
-                    # ignore this line
-                    pass
+        if data[:1] == b'\3':
+            return self._read_binary_metadata(data)
+        self._read_text_metadata(io.StringIO(data.decode('utf-8', 'replace'),
+                                             newline=''))
+        return False
+
+    def _read_binary_metadata(self, data):
+        record = self.log_record
+        end = len(data)
+        pos = 0
+        while pos + record.size <= end:
+            kind, length = record.unpack_from(data, pos)
+            pos = pos + record.size
+            if pos + length > end:
+                # a record cut short by a crash; have the log rewritten
+                # rather than append after the partial bytes
+                return False
+            try:
+                value = data[pos:pos + length].decode('utf-8')
+            except UnicodeDecodeError:
+                return False            # garbled, likewise
+            pos = pos + length
+            self.log_records = self.log_records + 1
+            if kind == 2:  # use update
+                if value in self.use_order:
+                    self.use_order.move_to_end(value)
+            elif kind == 1:  # delete
+                self._forget_entry(value)
+            elif kind == 0:  # add
+                newentry = DiskCacheEntry(self)
+                newentry.parse_fields(value.split('\0'))
+                self._replay_entry(newentry)
+            elif kind == 3:  # version
+                if value not in self.log_ok_versions:
+                    self._forget_all_entries()
+                    return False
+        # trailing bytes too short for a record header are a partial
+        # record as well
+        return pos == end
+
+    def _replay_entry(self, newentry):
+        if newentry.key not in self.items:
+            self.use_order[newentry.key] = None
+        newentry.cache = self
+        if newentry.expires:
+            self.add_expireable(newentry)
+        self.items[newentry.key] = newentry
+        self.manager.items[newentry.key] = newentry
+        self.size = self.size + newentry.size
+
+    def _forget_entry(self, key):
+        if key in self.items:
+            self.size = self.size - self.items.pop(key).size
+            del self.manager.items[key]
+            del self.use_order[key]
+            self.expires.pop(key, None)
+
+    def _forget_all_entries(self):
+        self.use_order = OrderedDict()
+        for key in self.items.keys():
+            del self.manager.items[key]
+        self.items.clear()
+        self.expires.clear()
+        self.expire_heap = []
+        self.size = 0
+
+    def _read_text_metadata(self, log):
+        for line in log:
+            try:
+                kind = line[0:1]
+                if kind == '2':  # use update
+                    key = line[2:-1]
+                    if key in self.use_order:
+                        self.use_order.move_to_end(key)
+                elif kind == '1':           # delete
+                    key = line[2:-1]
+                    self._forget_entry(key)
+                elif kind == '0':  # add
+                    newentry = DiskCacheEntry(self)
+                    newentry.parse(line[2:-1])
+                    self._replay_entry(newentry)
+                elif kind == '3':  # version (hopefully first)
+                    ver = line[2:-1]
+                    if ver not in self.log_text_versions:
+                        # clear out anything we might have read
+                        # and bail. this is an old log file.
+                        self._forget_all_entries()
+                        return
+            except IndexError:
+                # ignore this line
+                pass
 
-    def _checkpoint_metadata(self):
+    def _checkpoint_metadata(self, incremental=False):
         """Checkpoint the transaction log.
 
         Creates a new log that contains only the current state of the
-        cache.
+        cache. If incremental is true, the log is only rewritten when
+        it has grown log_garbage_ratio times larger than the cache
+        contents; otherwise pending records are merely flushed.
         """
         import traceback
+        if incremental and self.log and self.log_records <= \
+           self.log_garbage_ratio * len(self.items) + 1:
+            self.flush_log()
+            return
         if self.log:
             self.log.close()
+            self.log = None
         try:
             newpath = os.path.join(self.directory, 'CHECKPOINT')
 
-            with open(newpath, 'w') as newlog:
-                newlog.write('3 ' + self.log_version + '\n')
+            with open(newpath, 'wb') as newlog:
+                self.log_records = 0
+                self._write_record(newlog, 3, self.log_version)
                 for key in self.use_order:
                     self.log_entry(self.items[key], alt_log=newlog,
                                    flush=False)
                     # don't flush writes during the checkpoint, because if
                     # we crash it won't matter
             logpath = os.path.join(self.directory, 'LOG')
-            os.unlink(logpath)
-            os.rename(newpath, logpath)
+            os.replace(newpath, logpath)
         except:
             print("exception during checkpoint")
             traceback.print_exc()
@@ -652,7 +762,13 @@ class DiskCache:
     def _reinit_log(self):
         """Open the log for writing new transactions."""
         logpath = os.path.join(self.directory, 'LOG')
-        self.log = open(logpath, 'a')
+        self.log = open(logpath, 'ab')
+        self.log_pending = 0
+
+    def _write_record(self, dest, kind, value):
+        data = value.encode('utf-8')
+        dest.write(self.log_record.pack(kind, len(data)) + data)
+        self.log_records = self.log_records + 1
 
     def log_entry(self, entry, delete=False, alt_log=None, flush=True):
         """Write to the log adds and evictions."""
@@ -661,20 +777,96 @@ class DiskCache:
         else:
             dest = self.log
         if delete:
-            dest.write('1 ' + entry.key + '\n')
+            self._write_record(dest, 1, entry.key)
         else:
-            dest.write('0 ' + entry.unparse() + '\n')
+            self._write_record(dest, 0, entry.unparse('\0'))
         if flush:
-            dest.flush()
+            if dest is self.log:
+                self.flush_log()
+            else:
+                dest.flush()
 
     def log_use_order(self, key):
-        """Write to the log changes in use_order."""
+        """Write to the log changes in use_order.
+
+        These records only affect the LRU order, so they are flushed
+        in groups of log_flush_records, and at most log_flush_interval
+        seconds after the first of a group was written.
+        """
         if key in self.items:
-            self.log.write('2 ' + key + '\n')
-            # should we flush() here? probably...
+            self._write_record(self.log, 2, key)
+            self.log_pending = self.log_pending + 1
+            if self.log_pending >= self.log_flush_records:
+                self.flush_log()
+            elif self.log_timer is None:
+                self.log_timer = self.manager.app.root.after(
+                    int(self.log_flush_interval * 1000), self.flush_log)
+
+    def flush_log(self):
+        """Write out any use_order updates not yet flushed."""
+        if self.log_timer is not None:
+            self.manager.app.root.after_cancel(self.log_timer)
+            self.log_timer = None
+        if self.log:
             self.log.flush()
+        self.log_pending = 0
+
+    cache_file = re.compile(r'^(spam[0-9]+|[0-9a-f]{40})')
+    shard_dir = re.compile(r'^[0-9a-f]{2}$')
 
-    cache_file = re.compile(r'^spam[0-9]+')
+    def _migrate_flat_files(self):
+        """Move files of the old flat layout into their shards.
+
+        Returns true if any entry was renamed, in which case the log
+        must be checkpointed to record the new file names.
+        """
+        migrated = False
+        for entry in self.items.values():
+            if not entry.file or '/' in entry.file:
+                continue
+            filename = self.get_file_name(entry)
+            path = self.get_file_path(filename)
+            try:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(self.get_file_path(entry.file), path)
+            except OSError:
+                # leave it where it is; get() still finds it
+                continue
+            entry.file = filename
+            migrated = True
+        return migrated
+
+    def _erase_files(self, known=()):
+        """Delete cache files not named in known, one shard at a time.
+
+        Shard directories left empty are removed as well.
+        """
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if self.shard_dir.match(name) and os.path.isdir(path):
+                for subname in os.listdir(path):
+                    subpath = os.path.join(path, subname)
+                    if self.shard_dir.match(subname) \
+                       and os.path.isdir(subpath):
+                        self._erase_shard(subpath, name + '/' + subname,
+                                          known)
+                try:
+                    os.rmdir(path)
+                except OSError:
+                    pass
+            elif name not in known and self.cache_file.match(name):
+                # a file of the old flat layout
+                os.unlink(path)
+
+    def _erase_shard(self, path, shard, known):
+        for file in os.listdir(path):
+            if shard + '/' + file not in known \
+               and self.cache_file.match(file):
+                os.unlink(os.path.join(path, file))
+        try:
+            os.rmdir(path)
+        except OSError:
+            pass
 
     def erase_cache(self):
 
@@ -683,11 +875,7 @@ class DiskCache:
             self.manager.disk.erase_cache()
             return
 
-        for dir, _, files in os.walk(self.directory):
-            for file in files:
-                if self.cache_file.match(file):
-                    path = os.path.join(dir, file)
-                    os.unlink(path)
+        self._erase_files()
 
         self.manager.reset_disk_cache(flush_log=True)
 
@@ -698,20 +886,13 @@ class DiskCache:
             self.manager.disk.erase_unlogged_files()
             return
 
-        known = {'LOG'}
-        known.update(entry.file for entry in self.items.values())
-
-        for dir, _, files in os.walk(self.directory):
-            for file in files:
-                if file not in known and self.cache_file.match(file):
-                    path = os.path.join(dir, file)
-                    os.unlink(path)
+        known = {entry.file for entry in self.items.values()}
+        self._erase_files(known)
 
     def get(self, key):
         """Update and log use_order."""
         assert key in self.items
-        self.use_order.remove(key)
-        self.use_order.append(key)
+        self.use_order.move_to_end(key)
         self.log_use_order(key)
 
     def update(self, object):
@@ -747,7 +928,7 @@ class DiskCache:
 
         self.items[object.key] = newitem
         self.manager.items[object.key] = newitem
-        self.use_order.append(object.key)
+        self.use_order[object.key] = None
 
         return newitem
 
@@ -772,15 +953,28 @@ class DiskCache:
 
     def add_expireable(self, entry):
         """Adds entry to list of pages with explicit expire date."""
-        self.expires.append(entry)
+        self.expires[entry.key] = entry
+        heapq.heappush(self.expire_heap,
+                       (expire_key(entry), next(self.expire_seq), entry))
+        if len(self.expire_heap) > 2 * len(self.expires) + 64:
+            # too many stale entries left behind by LRU eviction
+            self.expire_heap = [item for item in self.expire_heap
+                                if self.expires.get(item[2].key) is item[2]]
+            heapq.heapify(self.expire_heap)
 
     def get_file_name(self, entry):
-        """Invent a filename for a new cache entry."""
-        filename = 'spam' + str(time.time()) + self.get_suffix(entry.type)
+        """Invent a filename for a new cache entry.
+
+        The name is relative to the cache directory and always uses
+        '/' as separator, since it is written to the log.
+        """
+        digest = hashlib.sha1(entry.key.encode('utf-8')).hexdigest()
+        filename = '/'.join((digest[:2], digest[2:4], digest)) \
+            + self.get_suffix(entry.type)
         return filename
 
     def get_file_path(self, filename):
-        path = os.path.join(self.directory, filename)
+        path = os.path.join(self.directory, *filename.split('/'))
         return path
 
     def get_suffix(self, type):
@@ -793,8 +987,9 @@ class DiskCache:
         """Write the object's data to disk."""
         path = self.get_file_path(entry.file)
         try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
             with open(path, 'wb') as f:
-                f.writelines(object.data)
+                f.write(object.data)
         except IOError as err:
             raise CacheFileError(path) from err
 
@@ -828,32 +1023,26 @@ class DiskCache:
         """Evict the least recently used page."""
         # get ride of least-recently used thing
         if len(self.items) > 0:
-            key = self.use_order[0]
+            key = next(iter(self.use_order))
             self.evict(key)
         else:
             raise CacheEmpty
 
     def evict_expired_pages(self):
         """Evict any pages on the expires list that have expired."""
-        self.expires.sort(key=expire_key)
-        size = len(self.expires)
-        if size > 0 \
-           and self.expires[0].expires.get_secs() < time.time():
-            index = 0
-            t = time.time()
-            while index < size and self.expires[index].expires.get_secs() < t:
-                index = index + 1
-            for item in self.expires[0:index]:
-                self.evict(item.key)
-            del self.expires[0:index]
+        heap = self.expire_heap
+        t = time.time()
+        while heap and heap[0][0] < t:
+            entry = heapq.heappop(heap)[2]
+            if self.expires.get(entry.key) is entry:
+                self.evict(entry.key)
 
     def evict(self, key):
         """Remove an entry from the cache and delete the file from disk."""
-        self.use_order.remove(key)
+        del self.use_order[key]
         evictee = self.items.pop(key)
         del self.manager.items[key]
-        if key in self.expires:
-            self.expires.remove(key)
+        self.expires.pop(key, None)
         try:
             os.unlink(self.get_file_path(evictee.file))
         except EnvironmentError as err:
@@ -865,7 +1054,12 @@ class DiskCache:
 
 
 class disk_cache_access:
-    """protocol access interface for disk cache"""
+    """protocol access interface for disk cache
+
+    The file is memory-mapped when possible; getview() then returns a
+    memoryview of the whole body, so that a SharedItem can serve any
+    offset from the map instead of keeping a copy of the data.
+    """
 
     def __init__(self, filename, content_type, date, len,
                  content_encoding, transfer_encoding):
@@ -882,6 +1076,16 @@ class disk_cache_access:
         except IOError as err:
             print("io error opening {}: {}".format(filename, err))
             raise
+        self.map = None
+        self.view = None
+        self.pos = 0
+        try:
+            self.map = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            # empty file, or a file system that can't map it
+            pass
+        else:
+            self.view = memoryview(self.map)
         self.state = DATA
 
     def pollmeta(self):
@@ -895,11 +1099,19 @@ class disk_cache_access:
 
     def getdata(self, maxbytes):
         # get some data from the disk
-        data = self.fp.read(maxbytes)
+        if self.view is not None:
+            data = self.view[self.pos:self.pos + maxbytes].tobytes()
+            self.pos = self.pos + len(data)
+        else:
+            data = self.fp.read(maxbytes)
         if not data:
             self.state = DONE
         return data
 
+    def getview(self):
+        """Return a memoryview of the mapped file, or None."""
+        return self.view
+
     def fileno(self):
         try:
             return self.fp.fileno()
@@ -907,6 +1119,12 @@ class disk_cache_access:
             return -1
 
     def close(self):
+        view = self.view
+        self.view = None
+        if view is not None:
+            view.release()
+            self.map.close()
+            self.map = None
         fp = self.fp
         self.fp = None
         if fp:
@@ -968,3 +1186,46 @@ class HTTime:
             return self.str
         else:
             return str(None)
+
+
+def benchmark(lines=100000):
+    """Time replaying a LOG of adds followed by use_order updates."""
+    import random
+    import shutil
+    import tempfile
+    entries = lines // 10
+    directory = tempfile.mkdtemp()
+    record = DiskCache.log_record
+
+    def pack(kind, value):
+        data = value.encode('utf-8')
+        return record.pack(kind, len(data)) + data
+
+    try:
+        keys = ['http://www.example.com/{}.html'.format(i)
+                for i in range(entries)]
+        records = [pack(3, DiskCache.log_version)]
+        for key in keys:
+            fields = [key, key, '', 1024, time.time(), None, None,
+                      'text/html', None, None]
+            records.append(pack(0, '\0'.join(map(str, fields))))
+        for i in range(lines - entries):
+            records.append(pack(2, random.choice(keys)))
+        with open(os.path.join(directory, 'LOG'), 'wb') as log:
+            log.write(b''.join(records))
+        manager = CacheManager.__new__(CacheManager)
+        manager.caches = []
+        manager.items = {}
+        t0 = time.time()
+        cache = DiskCache(manager, 2**30, directory)
+        t1 = time.time()
+        cache.log.close()
+        print("{} records, {} entries: {:.2f} seconds".format(
+            len(records), len(cache.items), t1 - t0))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(*map(int, sys.argv[1:2]))
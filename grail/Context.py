@@ -289,7 +289,7 @@ class Context(URIContext):
             return None
 
         # try loading from the cache
-        image = self.app.get_cached_image((url, width, height))
+        image = self.app.get_cached_image((url, width, height), self.viewer)
         if image and (not reload or image.is_reloading()):
             if not image.loaded:
                 image.start_loading(self)
@@ -8,11 +8,13 @@ import posixpath
 
 from tkinter import *
 from io import RawIOBase
+from collections import OrderedDict
 
 from . import filetypes
 from . import tktools
 from . import grailutil
 from . import BaseApplication
+from . import protocols
 from . import Stylesheet
 from . import GlobalHistory
 
@@ -165,38 +167,115 @@ class URLReadWrapper(RawIOBase):
 
 class SocketQueue:
 
-    def __init__(self, max_sockets):
+    """Hand out a limited number of sockets to protocol objects.
+
+    A requestor waiting for a socket is queued under its priority
+    class (see protocols.PRIORITY_NAMES) and its host. Sockets go to
+    the most urgent class first; within a class, hosts take turns,
+    and no host gets more than max_per_host sockets at a time.
+    Queueing and dequeueing are O(1); picking the next requestor only
+    looks at the hosts that have requests waiting.
+    """
+
+    def __init__(self, max_sockets, max_per_host=4):
         self.max = max_sockets
-        self.blocked = []
-        self.callbacks = {}
+        self.max_per_host = max_per_host
+        # per priority class: host -> OrderedDict of requestor -> callback
+        self.queues = [OrderedDict() for name in protocols.PRIORITY_NAMES]
+        self.waiting = {}                   # requestor -> (priority, host)
+        self.owners = {}                    # requestor -> host
+        self.hosts = {}                     # host -> number of sockets
         self.open = 0
+        self.granted = 0
+        self.queued = 0
 
-    def change_max(self, new_max):
-        old_max = self.max
+    @property
+    def blocked(self):
+        return list(self.waiting)
+
+    def change_max(self, new_max, max_per_host=None):
         self.max = new_max
-        if old_max < new_max and len(self.blocked) > 0:
-            for i in range(0, min(new_max - old_max, len(self.blocked))):
-                # run wild free sockets
-                self.open = self.open + 1
-                self.callbacks.pop(self.blocked.pop(0))()
-
-    def request_socket(self, requestor, callback):
-        if self.open >= self.max:
-            self.blocked.append(requestor)
-            self.callbacks[requestor] = callback
+        if max_per_host:
+            self.max_per_host = max_per_host
+        self.schedule()
+
+    def request_socket(self, requestor, callback, host=None,
+                       priority=protocols.PRIORITY_DOCUMENT):
+        if self.waiting or not self.available(host):
+            priority = min(max(priority, 0), len(self.queues) - 1)
+            self.waiting[requestor] = priority, host
+            self.queues[priority].setdefault(host, OrderedDict())[
+                requestor] = callback
+            self.queued = self.queued + 1
+            self.schedule()
         else:
-            self.open = self.open + 1
-            callback()
+            self.grant(requestor, host, callback)
 
     def return_socket(self, owner):
-        if owner in self.blocked:
+        if owner in self.waiting:
             # died before its time
-            self.blocked.remove(owner)
-            del self.callbacks[owner]
-        elif len(self.blocked) > 0:
-            self.callbacks.pop(self.blocked.pop(0))()  # apply callback
+            priority, host = self.waiting.pop(owner)
+            queue = self.queues[priority]
+            del queue[host][owner]
+            if not queue[host]:
+                del queue[host]
+            return
+        if owner not in self.owners:
+            return
+        host = self.owners.pop(owner)
+        self.open = self.open - 1
+        count = self.hosts[host] - 1
+        if count:
+            self.hosts[host] = count
         else:
-            self.open = self.open - 1
+            del self.hosts[host]
+        self.schedule()
+
+    def available(self, host):
+        return self.open < self.max and (
+            host is None or self.hosts.get(host, 0) < self.max_per_host)
+
+    def grant(self, requestor, host, callback):
+        self.open = self.open + 1
+        self.hosts[host] = self.hosts.get(host, 0) + 1
+        self.owners[requestor] = host
+        self.granted = self.granted + 1
+        callback()
+
+    def schedule(self):
+        """Give free sockets to the most urgent waiting requestors."""
+        while self.open < self.max and self.waiting:
+            for queue in self.queues:
+                for host, requestors in queue.items():
+                    if self.available(host):
+                        break
+                else:
+                    continue
+                requestor, callback = requestors.popitem(last=False)
+                del self.waiting[requestor]
+                del queue[host]
+                if requestors:
+                    # let the other hosts of this class go first
+                    queue[host] = requestors
+                self.grant(requestor, host, callback)
+                break
+            else:
+                # every waiting host is at its limit
+                return
+
+    def stats(self):
+        """Return a dictionary describing the state of the queue."""
+        return {
+            'open': self.open,
+            'max': self.max,
+            'max-per-host': self.max_per_host,
+            'granted': self.granted,
+            'queued': self.queued,
+            'hosts': dict(self.hosts),
+            'waiting': {name: sum(map(len, queue.values()))
+                        for name, queue in zip(protocols.PRIORITY_NAMES,
+                                               self.queues)},
+        }
 
 
 class Application(BaseApplication.BaseApplication):
@@ -218,19 +297,28 @@ class Application(BaseApplication.BaseApplication):
 
         # socket management
         sockets = self.prefs.GetInt('sockets', 'number')
-        self.sq = SocketQueue(sockets)
+        self.sq = SocketQueue(sockets,
+                              self.prefs.GetInt('sockets', 'per-host'))
         self.prefs.AddGroupCallback('sockets',
                                     lambda self=self:
                                     self.sq.change_max(
                                         self.prefs.GetInt('sockets',
-                                                          'number')))
+                                                          'number'),
+                                        self.prefs.GetInt('sockets',
+                                                          'per-host')))
 
         # initialize on_exit_methods before global_history
         self.on_exit_methods = []
         self.global_history = GlobalHistory.GlobalHistory(self)
         self.login_cache = {}
         self.url_cache = CacheManager(self)
-        self.image_cache = ImageCache(self.url_cache)
+        self.image_cache = ImageCache(
+            self.url_cache, self.prefs.GetInt('image-cache', 'size') * 1024)
+        self.prefs.AddGroupCallback('image-cache',
+                                    lambda self=self:
+                                    self.image_cache.change_max(
+                                        self.prefs.GetInt('image-cache',
+                                                          'size') * 1024))
         self.auth = AuthenticationManager(self)
         self.root.report_callback_exception = self.report_callback_exception
         if sys.stdin.isatty():
@@ -303,8 +391,8 @@ class Application(BaseApplication.BaseApplication):
         # interrupts get through
         self.root.tk.createtimerhandler(KEEPALIVE_TIMER, self.keep_alive)
 
-    def get_cached_image(self, url):
-        return self.image_cache.get_image(url)
+    def get_cached_image(self, url, owner=None):
+        return self.image_cache.get_image(url, owner)
 
     def set_cached_image(self, url, image, owner=None):
         self.image_cache.set_image(url, image, owner)
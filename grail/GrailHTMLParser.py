@@ -14,6 +14,7 @@ from . import Viewer
 from . import grailutil
 
 from .grailutil import extract_keyword
+from .sgml import SGMLHandler
 from .sgml.HTMLParser import HTMLParser, HeaderNumber
 from ast import literal_eval
 
@@ -30,6 +31,8 @@ _inited = False
 
 
 def init_module(prefs):
+    # the 'override-builtin-tags' setting changes how tags are resolved
+    prefs.AddGroupCallback('parsing-html', SGMLHandler.flush_taginfo_tables)
     for opt in (1, 2, 3, 4, 5, 6):
         fmt = prefs.Get('parsing-html', 'format-h{}'.format(opt))
         HeaderNumber.set_default_format(opt - 1, literal_eval(fmt))
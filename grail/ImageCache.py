@@ -1,3 +1,10 @@
+from collections import OrderedDict
+from tkinter import TclError
+
+
+BYTES_PER_PIXEL = 4                     # Estimate of Tk's memory per pixel
+
+
 class ImageCache:
 
     """a cache for Tk image objects and their python wrappers
@@ -5,15 +12,26 @@ class ImageCache:
     The current goal of this cache is to provide a safe mechanism for
     sharing image objects between multiple Viewer windows.
 
-    In future release, the image cache should actually delete objects
-    from the cache (what a concept!). Currently, a Grail process will
-    grow without bound as new images are displayed. This is a bug.
+    Each image is owned by the viewers that show it on their current
+    page; a viewer gives up its images when it is reset or closed.
+    When the decoded pixel data of the loaded images exceeds max_size
+    bytes, the least recently used images that have no owner left are
+    evicted.  Images that are still owned are never evicted, since
+    deleting a Tk image blanks it wherever it is shown.
     """
 
-    def __init__(self, url_cache):
-        self.image_objects = {}
+    def __init__(self, url_cache, max_size=16 * 1024 * 1024):
+        self.image_objects = OrderedDict()  # least recently used first
         self.old_objects = {}
         self.current_owners = {}
+        self.owned_images = {}              # owner -> set of keys
+        self.sizes = {}                     # key -> bytes, once loaded
+        self.unsized = set()                # keys not yet in sizes
+        self.size = 0                       # sum of sizes
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
         self.url_cache = url_cache
 
     def debug_show_state(self):
@@ -34,12 +52,16 @@ class ImageCache:
                     (height or 0))
         return None
 
-    def get_image(self, key):
+    def get_image(self, key, owner=None):
         key = self.form_key(key)
         if key:
             if key in self.image_objects:
                 self.url_cache.touch(key=key)
+                self.image_objects.move_to_end(key)
+                self.add_owner(key, owner)
+                self.hits = self.hits + 1
                 return self.image_objects[key]
+            self.misses = self.misses + 1
         return None
 
     def set_image(self, key, image, owner):
@@ -49,17 +71,94 @@ class ImageCache:
                or len(self.current_owners[key]) > 1:
                 for other_owner in self.current_owners[key]:
                     if other_owner != owner:
-                        self.keep_old_copy(other_owner, image, key)
+                        self.keep_old_copy(other_owner,
+                                           self.image_objects[key], key)
+                        self.owned_images[other_owner].discard(key)
             if owner in self.old_objects:
                 for pair in self.old_objects[owner]:
                     if pair[0] == key:
                         self.old_objects[owner].remove(pair)
+            self.size = self.size - self.sizes.pop(key, 0)
+        self.unsized.add(key)
         self.image_objects[key] = image
-        self.current_owners[key] = [owner]
+        self.image_objects.move_to_end(key)
+        self.current_owners[key] = []
+        self.add_owner(key, owner)
+        self.prune()
 
     def keep_old_copy(self, owner, image, key):
-        key = self.form_key(key)
         self.old_objects.setdefault(owner, []).append((key, image))
 
+    def add_owner(self, key, owner):
+        if owner is None:
+            return
+        if owner not in self.owned_images:
+            self.owned_images[owner] = set()
+            # a viewer gives up its images when it leaves the page
+            owner.register_reset_interest(self.owner_exiting)
+        self.owned_images[owner].add(key)
+        if owner not in self.current_owners[key]:
+            self.current_owners[key].append(owner)
+
     def owner_exiting(self, owner):
-        del self.old_objects[owner]
+        for key in self.owned_images.pop(owner, ()):
+            owners = self.current_owners.get(key)
+            if owners and owner in owners:
+                owners.remove(owner)
+        self.old_objects.pop(owner, None)
+        if self.owner_exiting in owner.reset_interests:
+            owner.unregister_reset_interest(self.owner_exiting)
+        self.prune()
+
+    def change_max(self, max_size):
+        self.max_size = max_size
+        self.prune()
+
+    def image_size(self, key, image):
+        size = self.sizes.get(key)
+        if size is None:
+            if not getattr(image, 'loaded', False):
+                return 0
+            try:
+                size = image.width() * image.height() * BYTES_PER_PIXEL
+            except TclError:
+                size = 0
+            self.sizes[key] = size
+            self.unsized.discard(key)
+            self.size = self.size + size
+        return size
+
+    def prune(self):
+        """Evict unowned images until the cache fits in max_size."""
+        # only images that have finished loading since the last call
+        # add to the running total
+        for key in list(self.unsized):
+            self.image_size(key, self.image_objects[key])
+        if self.size <= self.max_size:
+            return
+        for key in list(self.image_objects):
+            if not self.current_owners[key]:
+                self.evict(key)
+                if self.size <= self.max_size:
+                    break
+
+    def evict(self, key):
+        image = self.image_objects.pop(key)
+        del self.current_owners[key]
+        self.size = self.size - self.sizes.pop(key, 0)
+        self.unsized.discard(key)
+        self.evictions = self.evictions + 1
+        cancel = getattr(image, 'cancel_decoding', None)
+        if cancel:
+            cancel()
+
+    def stats(self):
+        """Return a dictionary describing the state of the cache."""
+        return {
+            'images': len(self.image_objects),
+            'size': self.size,
+            'max-size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            }
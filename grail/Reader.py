@@ -22,18 +22,31 @@ caps = None
 # If > 0, profile handle_data and print this many statistics lines
 profiling = 0
 
+# Buffer size for documents that are already complete (cached or local
+# files); large pieces let the SGML lexer tokenize them in batches
+LOCAL_BUFSIZE = 64 * 1024
+
+# Milliseconds between forced display updates while a document is read;
+# while the end of the document is in view, updates follow the reader's
+# time budget instead
+RENDER_INTERVAL = 250
+
 
 class ParserWrapper:
     """Provides re-entrance protection around an arbitrary parser object.
     """
 
-    def __init__(self, parser, viewer):
+    def __init__(self, parser, viewer, interval=RENDER_INTERVAL,
+                 framebudget=BaseReader.timebudget):
         self.__parser = parser
         self.__viewer = viewer
         self.__pendingdata = bytearray()
         self.__closed = False
         self.__closing = False
         self.__level = 0
+        self.__interval = interval / 1000.0
+        self.__framebudget = framebudget / 1000.0
+        self.__lastupdate = 0.0
 
     def feed(self, data):
         self.__pendingdata.extend(data)
@@ -46,9 +59,23 @@ class ParserWrapper:
                 self.__parser.feed(data)
             if self.__closing and not self.__closed:
                 self.__parser.close()
-            self.__viewer.freeze(True)
+            self.__viewer.freeze(self.__update_due())
         self.__level = self.__level - 1
 
+    def __update_due(self):
+        # Force a display update only now and then: at the frame rate
+        # while new text lands in view, otherwise every interval
+        now = time.perf_counter()
+        elapsed = now - self.__lastupdate
+        if elapsed < self.__framebudget:
+            return False
+        if elapsed < self.__interval:
+            text = self.__viewer.text
+            if not text or text.bbox('end - 1 char') is None:
+                return False
+        self.__lastupdate = now
+        return True
+
     def close(self):
         self.__closing = True
         if not self.__level:
@@ -396,6 +423,8 @@ class Reader(BaseReader):
 
     """
 
+    render_interval = RENDER_INTERVAL
+
     def __init__(self, context, url, method, params, show_source, reload,
                  data=None, scrollpos=None):
 
@@ -421,6 +450,10 @@ class Reader(BaseReader):
 
         self.viewer = self.last_context.viewer
         self.app = self.last_context.app
+        if self.app:
+            prefs = self.app.prefs
+            self.timebudget = prefs.GetInt('browser', 'frame-budget')
+            self.render_interval = prefs.GetInt('browser', 'render-interval')
 
         self.parser = None
 
@@ -443,6 +476,13 @@ class Reader(BaseReader):
             tuple = (tuple[0], netloc) + tuple[2:]
         realurl = urllib.parse.urlunparse(tuple)
 
+        # Documents for subframes queue behind the top level document
+        from . import protocols
+        if self.viewer.parent:
+            self.params['.priority'] = protocols.PRIORITY_FRAME
+        else:
+            self.params['.priority'] = protocols.PRIORITY_DOCUMENT
+
         # Check first to see if the previous Context has any protocol handlers
         api = self.last_context.get_local_api(realurl, self.method,
                                               self.params)
@@ -452,7 +492,6 @@ class Reader(BaseReader):
                                         self.method, self.params, self.reload,
                                         data=self.data)
             else:
-                from . import protocols
                 api = protocols.protocol_access(realurl,
                                                 self.method, self.params,
                                                 data=self.data)
@@ -641,7 +680,11 @@ class Reader(BaseReader):
         parser = wrap_parser(parser, content_type,
                              content_encoding, transfer_encoding)
         # protect from re-entrance
-        self.parser = ParserWrapper(parser, self.viewer)
+        self.parser = ParserWrapper(parser, self.viewer,
+                                    self.render_interval, self.timebudget)
+        if self.api.iscached() \
+           or urllib.parse.urlparse(self.url).scheme == 'file':
+            self.bufsize = LOCAL_BUFSIZE
 
     def handle_auth_error(self, errcode, errmsg, headers):
         # Return True if handle_error() should return now
@@ -901,3 +944,32 @@ class TransferDisplay:
         self.__reader.save_file = self.__save_file
         self.__save_file = self.__reader = None
         self.root.destroy()
+
+
+def benchmark(url):
+    """Time how long a page takes to be read and displayed.
+
+    url may also be the name of a local file.
+    """
+    from .Grail import Application
+    from .Browser import Browser
+    from .grailbase import GrailPrefs
+    import urllib.request
+    if not urllib.parse.urlparse(url).scheme:
+        url = 'file:' + urllib.request.pathname2url(os.path.abspath(url))
+    app = Application(prefs=GrailPrefs.AllPreferences())
+    browser = Browser(app.root, app)
+    context = browser.context
+    t0 = time.perf_counter()
+    context.load(url)
+    while context.busy():
+        app.root.tk.dooneevent()
+    app.root.update_idletasks()
+    t1 = time.perf_counter()
+    print("{}: {:.3f} seconds, {} runs in {} text inserts".format(
+        url, t1 - t0, context.viewer.insertruns, context.viewer.insertcalls))
+    browser.close()
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1])
@@ -168,7 +168,10 @@ class Viewer(formatter.AbstractWriter):
         self.spacingtag = None          # Tag specifying spacing
         self.addtags = ()               # Additional tags (e.g. anchors)
         self.align = None               # Alignment setting
-        self.pendingdata = ''           # Data 'on hold'
+        self.pendingdata = []           # Pieces of the open run of text
+        self.pendingruns = []           # Closed (text, tags) runs, flattened
+        self.insertcalls = 0            # text.insert() calls for this page
+        self.insertruns = 0             # (text, tags) runs they carried
         self.targets = set()               # Mark names for anchors/footnotes
         self.new_tags()
 
@@ -407,7 +410,8 @@ class Viewer(formatter.AbstractWriter):
         for w in subwindows:
             w.destroy()
         if self.text:
-            self.pendingdata = ''
+            self.pendingdata = []
+            self.pendingruns = []
             self.unfreeze()
             self.text.delete('1.0', END)
             self.freeze()
@@ -461,9 +465,8 @@ class Viewer(formatter.AbstractWriter):
         self.text['state'] = NORMAL
 
     def freeze(self, update=False):
-        if self.pendingdata and self.pendingdata.strip():
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.close_run()
+        self.insert_runs()
         if self.smoothscroll:
             from .supertextbox import resize_super_text_box
             resize_super_text_box(frame=self.frame)
@@ -472,9 +475,67 @@ class Viewer(formatter.AbstractWriter):
             self.text.update_idletasks()
 
     def flush(self):
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.close_run(True)
+        self.insert_runs()
+
+    def close_run(self, force=False):
+        """End the open run of text and queue it with the current tags.
+
+        Unless force is true, a run of nothing but whitespace is kept
+        open so that it picks up the next set of tags instead.
+        """
+        pieces = self.pendingdata
+        if not pieces:
+            return
+        data = ''.join(pieces)
+        if not (force or data.strip()):
+            self.pendingdata = [data]
+            return
+        self.pendingdata = []
+        runs = self.pendingruns
+        if runs and runs[-1] == self.flowingtags:
+            runs[-2] = runs[-2] + data
+        else:
+            runs.append(data)
+            runs.append(self.flowingtags)
+
+    def insert_runs(self, *segments):
+        """Insert the queued runs, then segments, with one Tk call.
+
+        If runlog is a list, the runs are also appended to it.
+        """
+        args = self.pendingruns
+        if segments:
+            args.extend(segments)
+        if args:
+            self.pendingruns = []
+            self.text.insert(END, *args)
+            if self.runlog is not None:
+                self.runlog.extend(args)
+            self.insertcalls = self.insertcalls + 1
+            self.insertruns = self.insertruns + len(args) // 2
+
+    def replay_runs(self, runs):
+        """Insert runs recorded by another viewer's runlog.
+
+        Font and anchor tags are normally set up as the formatter
+        asks for them, so any this widget has not seen yet are
+        configured first.
+        """
+        built = self.__fonttags_built or {}
+        styles = self.stylesheet.styles
+        for tags in set(runs[1::2]):
+            for tag in tags:
+                if tag in built:
+                    continue
+                if tag in styles:
+                    self.configure_fonttag(tag)
+                elif tag[:1] == '>':
+                    self.bind_anchors(tag)
+        if runs:
+            self.text.insert(END, *runs)
+            self.insertcalls = self.insertcalls + 1
+            self.insertruns = self.insertruns + len(runs) // 2
 
     def scroll_page_down(self, event=None):
         self.text.tk.call('tkScrollByPages', self.text.vbar, 'v', 1)
@@ -489,9 +550,7 @@ class Viewer(formatter.AbstractWriter):
         self.text.tk.call('tkScrollByUnits', self.text.vbar, 'v', -1)
 
     def new_tags(self):
-        if self.pendingdata and self.pendingdata.strip():
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.close_run()
         self.flowingtags = tuple(filter(
             None,
             (self.align, self.fonttag, self.margintag, self.rightmargintag,
@@ -513,7 +572,7 @@ class Viewer(formatter.AbstractWriter):
         else:
             tag = None
         if tag != self.fonttag:
-            self.flush()
+            self.close_run(True)
             self.fonttag = tag
         self.new_tags()
 
@@ -555,9 +614,7 @@ class Viewer(formatter.AbstractWriter):
     def new_styles(self, styles):
         ##      print('New styles:', styles)
         self.addtags = styles
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.close_run(True)
         self.rightmarginlevel = rl = styles.count('blockquote')
         self.rightmargintag = ('rightmargin_{}'.format(rl)) if rl else None
         self.flowingtags = tuple(filter(
@@ -566,11 +623,11 @@ class Viewer(formatter.AbstractWriter):
              self.spacingtag) + styles))
 
     def send_paragraph(self, blankline):
-        self.pendingdata = self.pendingdata + ('\n' * blankline)
+        self.pendingdata.append('\n' * blankline)
 # self.text.update_idletasks()
 
     def send_line_break(self):
-        self.pendingdata = self.pendingdata + '\n'
+        self.pendingdata.append('\n')
 # self.text.update_idletasks()
 
     def width_magic(self, abswidth, percentwidth):
@@ -591,48 +648,42 @@ class Viewer(formatter.AbstractWriter):
     def send_label_data(self, data):
         ##      print("Label data:", repr(data))
         tags = self.flowingtags + ('label_{}'.format(self.marginlevel),)
+        self.close_run(True)
         if isinstance(data, str):
-            self.text.insert(END, self.pendingdata, self.flowingtags,
-                             '\t{}\t'.format(data), tags)
-            self.pendingdata = ''
+            self.insert_runs('\t{}\t'.format(data), tags)
         elif isinstance(data, Iterable):
             #  (string, fonttag) pair
             data, fonttag = data
             if fonttag:
-                self.text.insert(END, self.pendingdata, self.flowingtags,
-                                 '\t', tags,
-                                 data, tags + (fonttag,))
+                self.insert_runs('\t', tags, data, tags + (fonttag,))
                 self.text.tag_raise(fonttag)
-                self.pendingdata = '\t'
+                self.pendingdata.append('\t')
             else:
-                self.text.insert(END, self.pendingdata, self.flowingtags,
-                                 '\t{}\t'.format(data), tags)
-                self.pendingdata = ''
+                self.insert_runs('\t{}\t'.format(data), tags)
         else:
             #  Some sort of image specified by DINGBAT or SRC
-            self.text.insert(END, self.pendingdata, self.flowingtags,
-                             '\t', tags)
-            self.pendingdata = ''
+            self.insert_runs('\t', tags)
             window = Label(self.text, image=data,
                            background=self.text['background'],
                            borderwidth=0)
             self.add_subwindow(window, align=BASELINE)
-            self.pendingdata = '\t'
+            self.pendingdata.append('\t')
 
     def send_flowing_data(self, data):
         ##      print("Flowing data:", repr(data), self.flowingtags)
-        self.pendingdata = self.pendingdata + data
+        self.pendingdata.append(data)
 
     def send_literal_data(self, data):
         ##      print("Literal data:", repr(data), self.flowingtags + ('pre',))
-        self.text.insert(END, self.pendingdata, self.flowingtags,
-                         data, self.flowingtags + ('pre',))
-        self.pendingdata = ''
+        self.close_run(True)
+        self.insert_runs(data, self.flowingtags + ('pre',))
 
     # Viewer's own methods
 
     SHOW_TITLES = False
 
+    runlog = None                       # Record of inserted runs, if a list
+
     def anchor_enter(self, event):
         tagurl = self.find_tag_url()
         url, target = self.split_target(tagurl)
@@ -775,9 +826,7 @@ class Viewer(formatter.AbstractWriter):
             self.text.mark_unset(*self.targets)
 
     def add_target(self, fragment):
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.flush()
         self.text.mark_set(fragment, END + ' - 1 char')
         self.text.mark_gravity(fragment, 'left')
         self.targets.add(fragment)
@@ -827,14 +876,12 @@ class Viewer(formatter.AbstractWriter):
             align = self.align
         prev_align, self.align = self.align, align
         self.new_tags()
-        self.pendingdata = self.pendingdata + MIN_IMAGE_LEADER
+        self.pendingdata.append(MIN_IMAGE_LEADER)
         self.align = prev_align
         self.new_tags()
 
     def add_subwindow(self, window, align=CENTER, index=END):
-        if self.pendingdata:
-            self.text.insert(END, self.pendingdata, self.flowingtags)
-            self.pendingdata = ''
+        self.flush()
         window.bind("<Button-3>", self.button_3_event)
         self.subwindows.append(window)
         self.text.window_create(index, window=window, align=align)
@@ -5,8 +5,20 @@ primarily to decide how to color links in the Browser windows, and to
 maintain this history in a file.  It knows how to find and read
 Netscape 1.x history files, as well as Grail 0.x history files.
 Netscape 2.x history files are not parsable ASCII text (they're db
-files), which probably makes long-term sense for Grail as well, but
-aren't currently supported.
+files), and aren't currently supported.
+
+The history itself is kept in an sqlite3 database, which is only
+opened when the history is first used.  Lookups go to the database
+as they are needed, so starting up does not depend on the size of
+the history, and every visit is written as soon as it is made.  The
+first time the database is created, the old history files are read
+into it.
+
+Most links on a page have not been visited, so a Bloom filter of the
+URLs in the history answers those without going to the database.  The
+filter is saved in the database too, along with the id of the last
+URL it holds, so URLs added by a session that never exited are caught
+up on when it is loaded.
 
 There is only one GlobalHistory object per Application object, which
 is where you'll find it.  The Context object inserts new entries into
@@ -15,25 +27,34 @@ the Global History, while GrailHTMLParser objects query the history.
 TBD:
 
         1) Read Netscape 2 history files
-        2) Use db to manage the on-disk history mechanism
 
 """
 
+import hashlib
+import math
 import os
 import re
+import sqlite3
 import sys
 import time
+import urllib.request
 from .grailutil import *
 
 GRAIL_RE = re.compile(r'([^ \t]+)[ \t]+([^ \t]+)[ \t]+?(.*)')
 DEFAULT_NETSCAPE_HIST_FILE = os.path.join(gethome(), '.netscape-history')
 DEFAULT_GRAIL_HIST_FILE = os.path.join(getgraildir(), 'grail-history')
+DEFAULT_GRAIL_HIST_DB = os.path.join(getgraildir(), 'grail-history.db')
 
 # TBD: this should be an option.
 # An expiration of zero means no expiration
 GLOBAL_HISTORY_EXPIRATION_DAYS = 0
 EXPIRATION_SECS = GLOBAL_HISTORY_EXPIRATION_DAYS * 60 * 60 * 24
 
+# Sizing of the Bloom filter: about 1% false positives at capacity
+BLOOM_BITS_PER_URL = 10
+BLOOM_HASHES = 7
+BLOOM_MIN_URLS = 1024
+
 
 def now():
     return int(time.time() % (1 << 31))
@@ -98,6 +119,50 @@ class HistoryReader:
         histobj.mass_append(ghist)
 
 
+class BloomFilter:
+    """A compact set of strings that can only grow.
+
+    A string that was added is always found; one that was not is
+    found by mistake about 1% of the time, as long as no more than
+    capacity strings have been added.
+    """
+
+    def __init__(self, capacity, bits=None, count=0):
+        self.capacity = capacity
+        nbytes = math.ceil(capacity * BLOOM_BITS_PER_URL / 8)
+        self.nbits = nbytes * 8
+        if bits is None or len(bits) != nbytes:
+            bits = bytes(nbytes)
+            count = 0
+        self.bits = bytearray(bits)
+        self.count = count
+
+    def positions(self, key):
+        # double hashing: BLOOM_HASHES positions from one digest
+        digest = hashlib.blake2b(key.encode('utf-8', 'surrogatepass'),
+                                 digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        nbits = self.nbits
+        return [(h1 + i * h2) % nbits for i in range(BLOOM_HASHES)]
+
+    def add(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            bits[pos >> 3] |= 1 << (pos & 7)
+        self.count = self.count + 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for pos in self.positions(key):
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
 class GlobalHistory:
     """Global History simply remembers URLs, knows how to read and
     write history files, and can be queried to see if a particular URL
@@ -127,8 +192,121 @@ class GlobalHistory:
 
     def __init__(self, app, readonly=False):
         self._app = app
-        self._urlmap = {}               # for fast lookup
-        self._history = []              # to maintain order
+        self._readonly = readonly
+        self._db = None                 # opened on first use
+        self._filter = None             # loaded with the database
+        self._filter_lastid = 0         # last history id in the filter
+        self._filter_changed = False
+        self._urlmap = {}               # lookups made so far
+        if not readonly:
+            app.register_on_exit(self.on_app_exit)
+
+    def _get_db(self):
+        if self._db is None:
+            try:
+                self._db = self._open_db(DEFAULT_GRAIL_HIST_DB)
+            except sqlite3.Error as err:
+                sys.stderr.write('WARNING: cannot open {}: {}\n'.format(
+                    DEFAULT_GRAIL_HIST_DB, err))
+                sys.stderr.write('WARNING: history will not be saved\n')
+                self._db = self._open_db(':memory:')
+            self._load_filter()
+        return self._db
+
+    def _open_db(self, filename):
+        new = filename == ':memory:' or not os.path.exists(filename)
+        if self._readonly and new:
+            filename = ':memory:'
+        if self._readonly and not new:
+            uri = 'file:{}?mode=ro'.format(
+                urllib.request.pathname2url(filename))
+            db = sqlite3.connect(uri, uri=True)
+        else:
+            db = sqlite3.connect(filename)
+        if filename != ':memory:' and not self._readonly:
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+        if new or not self._readonly:
+            with db:
+                db.execute('CREATE TABLE IF NOT EXISTS history ('
+                           'id INTEGER PRIMARY KEY, '
+                           'url TEXT UNIQUE NOT NULL, '
+                           'title TEXT NOT NULL, '
+                           'timestamp INTEGER NOT NULL)')
+                db.execute('CREATE TABLE IF NOT EXISTS bloom ('
+                           'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                           'capacity INTEGER NOT NULL, '
+                           'bits BLOB NOT NULL, '
+                           'count INTEGER NOT NULL, '
+                           'lastid INTEGER NOT NULL)')
+        if new:
+            self._db = db
+            self._read_old_history()
+        return db
+
+    def _load_filter(self):
+        db = self._db
+        try:
+            row = db.execute('SELECT capacity, bits, count, lastid '
+                             'FROM bloom').fetchone()
+        except sqlite3.Error:
+            row = None                  # a readonly database without one
+        if row:
+            capacity, bits, count, lastid = row
+            self._filter = BloomFilter(capacity, bits, count)
+            if self._filter.count:
+                self._filter_lastid = lastid
+            # else it was saved with another size and starts over
+        else:
+            (maxid,) = db.execute('SELECT MAX(id) FROM history').fetchone()
+            self._filter = BloomFilter(max(BLOOM_MIN_URLS, 2 * (maxid or 0)))
+        self._catch_up_filter()
+
+    def _catch_up_filter(self):
+        # take in the URLs added since the filter was last brought up
+        # to date, by an earlier session or another process
+        cursor = self._db.execute('SELECT id, url FROM history '
+                                  'WHERE id > ? ORDER BY id',
+                                  (self._filter_lastid,))
+        for id, url in cursor:
+            self._add_to_filter(url)
+            self._filter_lastid = max(self._filter_lastid, id)
+
+    def _add_to_filter(self, url):
+        bloom = self._filter
+        if bloom is None or url in bloom:
+            return
+        if bloom.is_full():
+            self._rebuild_filter(2 * bloom.capacity)
+        else:
+            bloom.add(url)
+        self._filter_changed = True
+
+    def _rebuild_filter(self, capacity):
+        bloom = BloomFilter(capacity)
+        lastid = 0
+        for id, url in self._db.execute('SELECT id, url FROM history'):
+            bloom.add(url)
+            lastid = max(lastid, id)
+        self._filter = bloom
+        self._filter_lastid = max(self._filter_lastid, lastid)
+
+    def _save_filter(self):
+        if self._readonly or self._filter is None:
+            return
+        self._catch_up_filter()
+        if not self._filter_changed:
+            return
+        bloom = self._filter
+        with self._db as db:
+            db.execute('INSERT OR REPLACE INTO bloom '
+                       '(id, capacity, bits, count, lastid) '
+                       'VALUES (0, ?, ?, ?, ?)',
+                       (bloom.capacity, bytes(bloom.bits), bloom.count,
+                        self._filter_lastid))
+        self._filter_changed = False
+
+    def _read_old_history(self):
         # first try to load the Grail global history file
         fp = None
         try:
@@ -144,54 +322,69 @@ class GlobalHistory:
         finally:
             if fp:
                 fp.close()
-        if not readonly:
-            app.register_on_exit(self.on_app_exit)
+
+    def _store(self, url, title, timestamp):
+        with self._get_db() as db:
+            db.execute('INSERT INTO history (url, title, timestamp) '
+                       'VALUES (?, ?, ?) ON CONFLICT (url) DO UPDATE SET '
+                       'title = excluded.title, '
+                       'timestamp = excluded.timestamp',
+                       (url, title, timestamp))
+        self._urlmap[url] = (title, timestamp)
+        self._add_to_filter(url)
 
     def mass_append(self, histlist):
         histlist.reverse()
+        with self._get_db() as db:
+            db.executemany('INSERT INTO history (url, title, timestamp) '
+                           'VALUES (?, ?, ?) ON CONFLICT (url) DO UPDATE SET '
+                           'title = excluded.title, '
+                           'timestamp = excluded.timestamp',
+                           histlist)
+        self._urlmap.clear()
         for url, title, timestamp in histlist:
-            self._urlmap[url] = (title, timestamp)
-            self._history.append(url)
+            self._add_to_filter(url)
 
     def remember_url(self, url, title=''):
-        if url not in self._urlmap:
-            self._history.append(url)
-        elif not title:
-            title, oldts = self._urlmap[url]
-        self._urlmap[url] = (title, now())
+        if not title:
+            title = self.lookup_url(url)[0] or ''
+        self._store(url, title, now())
         # Debugging...
 #       print('remember_url:', url, self._urlmap[url])
 
     def set_title(self, url, title):
-        if url in self._urlmap:
-            old_title, when = self._urlmap[url]
-        else:
-            when = now()
-        self._urlmap[url] = (title, when)
+        old_title, when = self.lookup_url(url)
+        self._store(url, title, when or now())
 
     def lookup_url(self, url):
-        return self._urlmap.get(url, (None, None))
+        info = self._urlmap.get(url)
+        if info is None:
+            db = self._get_db()
+            if url not in self._filter:
+                return None, None       # certainly not in the history
+            row = db.execute(
+                'SELECT title, timestamp FROM history WHERE url = ?',
+                (url,)).fetchone()
+            info = self._urlmap[url] = row or (None, None)
+        return info
 
     def inhistory_p(self, url):
-        return url in self._urlmap
+        return self.lookup_url(url)[1] is not None
 
     def urls(self):
-        return self._history[:]
+        cursor = self._get_db().execute('SELECT url FROM history ORDER BY id')
+        return [url for (url,) in cursor]
 
     def on_app_exit(self):
-        with open(DEFAULT_GRAIL_HIST_FILE, 'w') as fp:
-            print('GRAIL-global-history-file-1', file=fp)
-            urls = self.urls()
-            urls.reverse()
-            expiration = EXPIRATION_SECS and (now() - EXPIRATION_SECS)
-            for url in urls:
-                title, timestamp = self._urlmap[url]
+        db = self._db
+        if db is not None:
+            self._save_filter()
+            if EXPIRATION_SECS:
                 # weed out expired links
-                if expiration and expiration > timestamp:
-                    continue
-                if not title or title == url:
-                    print('{}\t{}'.format(url, timestamp), file=fp)
-                else:
-                    line = '{}\t{}\t{}'.format(url, timestamp, title)
-                    print(line, file=fp)
+                with db:
+                    db.execute('DELETE FROM history WHERE timestamp < ?',
+                               (now() - EXPIRATION_SECS,))
+            db.close()
+            self._db = None
+            self._urlmap.clear()
         self._app.unregister_on_exit(self.on_app_exit)
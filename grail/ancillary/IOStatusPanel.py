@@ -62,18 +62,42 @@ class IOStatusPanel:
     def fill_info(self):
         count = 0
         self.infobox.delete(0, END)
+        self.add_socket_info()
+        self.add_image_info()
         for browser in self.app.browsers:
             count = count + 1
             headline = "<Browser {}>".format(count)
             self.infobox.insert(END, headline)
             self.add_context_info(browser.context)
 
+    def add_socket_info(self):
+        stats = self.app.sq.stats()
+        self.infobox.insert(END, "<Sockets {open} of {max} in use, "
+                            "{max-per-host} per host>".format(**stats))
+        waiting = ["{} {}".format(count, name)
+                   for name, count in stats['waiting'].items() if count]
+        if waiting:
+            self.infobox.insert(END, "   waiting: " + ", ".join(waiting))
+        for host, count in sorted(stats['hosts'].items()):
+            self.infobox.insert(END, "   {}: {}".format(host or "<local>",
+                                                        count))
+
+    def add_image_info(self):
+        stats = self.app.image_cache.stats()
+        self.infobox.insert(END, "<Images {images}, {size} of {max-size} "
+                            "bytes>".format(**stats))
+        self.infobox.insert(END, "   {hits} hits, {misses} misses, "
+                            "{evictions} evicted".format(**stats))
+
     def add_context_info(self, context, level=1):
         indent = "   " * level
         headline = context.get_url() or "<no document>"
         if context.viewer.name:
             headline = "{}: {}".format(context.viewer.name, headline)
         self.infobox.insert(END, indent + headline)
+        viewer = context.viewer
+        self.infobox.insert(END, "{}   text: {} runs in {} inserts".format(
+            indent, viewer.insertruns, viewer.insertcalls))
         for reader in context.readers:
             self.add_reader_info(reader, level + 1)
         for viewer in context.viewer.subviewers:
@@ -4,6 +4,7 @@ __version__ = '$Id: table.py,v 2.62 1999/03/05 21:55:36 fdrake Exp $'
 import re
 from .. import grailutil
 from tkinter import *
+import tkinter.font
 from formatter import AbstractWriter, AbstractFormatter
 from ..Viewer import Viewer
 from numbers import Real
@@ -13,6 +14,10 @@ FIXEDLAYOUT = 1
 AUTOLAYOUT = 2
 OCCUPIED = 101
 EMPTY = 102
+VIRTUAL_CELLS = 500                     # Cells before a table is virtualized
+VIRTUAL_MARGIN = 1                      # Screens of cells kept around the view
+MAX_SPARES = 50                         # Spare cell viewers kept per table
+MAX_LAYOUTS = 16                        # Widths a table remembers layouts for
 
 
 class BadMojoError(Exception):
@@ -407,6 +412,18 @@ class Table(AttrElem):
         self.lastbody = None
         self.lastcell = None
         self._mapped = False
+        # very large tables are virtualized: once there are more than
+        # virtual_cells cells, only the cells near the visible part of
+        # the page keep their widgets
+        self.virtual_cells = parentviewer.prefs.GetInt(
+            'browser', 'virtual-table-cells')
+        self._virtual = False
+        self._cellcount = 0
+        self._spares = []
+        self._showid = None
+        # resizes are laid out once the events have been handled
+        self._layoutid = None
+        self._forcelayout = False
         # register with the parent viewer
         self.parentviewer.register_reset_interest(self._reset)
         abswidth = None
@@ -430,6 +447,87 @@ class Table(AttrElem):
 
     def maxwidth(self): return self._maxwidth
 
+    def new_viewer(self):
+        pv = self.parentviewer
+        viewer = Viewer(master=self.container,
+                        context=pv.context,
+                        scrolling=False,
+                        stylesheet=pv.stylesheet,
+                        parent=pv)
+        if not pv.find_parentviewer():
+            viewer.RULE_WIDTH_MAGIC = viewer.RULE_WIDTH_MAGIC - 6
+        return viewer
+
+    def get_viewer(self):
+        # recycle the viewer of a virtualized cell if there is one
+        if self._spares:
+            return self._spares.pop()
+        return self.new_viewer()
+
+    def release_viewer(self, viewer):
+        if self._cleared:
+            return                      # the parent viewer closes it
+        if len(self._spares) >= MAX_SPARES:
+            viewer.close()
+            return
+        viewer.unfreeze()
+        viewer.text.delete('1.0', END)
+        viewer.freeze()
+        viewer.reset_state()
+        self._spares.append(viewer)
+
+    def cell_finished(self, cell):
+        self._cellcount = self._cellcount + 1
+        if self._virtual:
+            cell.hide()
+        elif 0 < self.virtual_cells < self._cellcount:
+            self._virtual = True
+            bodies = (self.thead or []) + self.tbodies + (self.tfoot or [])
+            for tb in bodies:
+                for trow in tb.trows:
+                    for cell in trow.cells:
+                        cell.hide()
+
+    def _bind_scrolling(self):
+        # scrolling the page moves the container of this table, or
+        # that of a table it is nested in
+        widget = self.container
+        while widget:
+            if isinstance(widget, Container):
+                widget.bind('<Configure>', self._schedule_show, add='+')
+            widget = widget.master
+
+    def _schedule_show(self, event=None):
+        if self._showid is None and not self._cleared:
+            self._showid = self.container.after_idle(self._show_visible)
+
+    def _show_visible(self):
+        # give widgets to the cells in or near the visible part of the
+        # page, and take them from the others
+        self._showid = None
+        if self._cleared:
+            return
+        container = self.container
+        view = self.parentviewer.context.viewer.text
+        if view and container.winfo_ismapped():
+            width = view.winfo_width()
+            height = view.winfo_height()
+            left = (view.winfo_rootx() - container.winfo_rootx()
+                    - VIRTUAL_MARGIN * width)
+            top = (view.winfo_rooty() - container.winfo_rooty()
+                   - VIRTUAL_MARGIN * height)
+            right = left + (2 * VIRTUAL_MARGIN + 1) * width
+            bottom = top + (2 * VIRTUAL_MARGIN + 1) * height
+        else:
+            left = top = right = bottom = 0
+        for cell in self._table.values():
+            if cell in (EMPTY, OCCUPIED):
+                continue
+            if cell.overlaps(left, top, right, bottom):
+                cell.show()
+            else:
+                cell.hide()
+
     def _map(self):
         if not self._mapped:
             self.container.pack()
@@ -445,6 +543,8 @@ class Table(AttrElem):
             self._autolayout_1()
             self._autolayout_2()
             self._autolayout_3()
+            if self._virtual:
+                self._bind_scrolling()
             if len(pv.context.readers) <= 1:
                 # if there are more readers than the one currently
                 # loading the page with the table, defer mapping the
@@ -607,20 +707,18 @@ class Table(AttrElem):
         # save these for the next phase of autolayout
         self._maxwidths = maxwidths
         self._minwidths = minwidths
+        self._columns = {}
 
     _prevwidth = -1
-
-    def _autolayout_3(self, force=False):
-        # This test protects against re-doing the layout if only the
-        # vertical size changed.
-        availablewidth = self.get_available_width()
-        if not force and availablewidth == self._prevwidth:
-            return
-        self._prevwidth = availablewidth
-
-        table = self._table
+    _canvassize = None
+
+    def _solve_columns(self, availablewidth):
+        # -> the width of each column when availablewidth pixels are
+        # available; cached until _autolayout_2() runs again
+        cellwidths = self._columns.get(availablewidth)
+        if cellwidths is not None:
+            return cellwidths
         colcount = self._colcount
-        rowcount = self._rowcount
         bw = self._borderwidth
         maxwidths = self._maxwidths
         minwidths = self._minwidths
@@ -688,6 +786,24 @@ class Table(AttrElem):
                 d = maxwidths[col] - minwidths[col]
                 adjustedwidths[col] = minwidths[col] + d * W // D
             cellwidths = adjustedwidths
+        if len(self._columns) >= MAX_LAYOUTS:
+            self._columns.clear()
+        self._columns[availablewidth] = cellwidths
+        return cellwidths
+
+    def _autolayout_3(self, force=False):
+        # This test protects against re-doing the layout if only the
+        # vertical size changed.
+        availablewidth = self.get_available_width()
+        if not force and availablewidth == self._prevwidth:
+            return
+        self._prevwidth = availablewidth
+
+        table = self._table
+        colcount = self._colcount
+        rowcount = self._rowcount
+        bw = self._borderwidth
+        cellwidths = self._solve_columns(availablewidth)
 
         # calculate column heights.  this should be done *after*
         # cellwidth calculations, due to side-effects in the cell
@@ -757,8 +873,12 @@ class Table(AttrElem):
             self.caption.situate(x=bw, y=ypos, height=height)
             ypos = ypos + height + self.Acellspacing
 
-        self.container.config(width=canvaswidth + 2 * self.Acellspacing,
-                              height=ypos - bw)
+        size = (canvaswidth + 2 * self.Acellspacing, ypos - bw)
+        if size != self._canvassize:
+            self._canvassize = size
+            self.container.config(width=size[0], height=size[1])
+        if self._virtual:
+            self._schedule_show()
 
     def _reset(self, viewer):
         # called when the viewer is cleared
@@ -770,17 +890,38 @@ class Table(AttrElem):
         self.parentviewer.prefs.RemoveGroupCallback(
             'styles', self._force_resize)
         delattr(self.container, '_table')
+        for id in self._showid, self._layoutid:
+            if id:
+                self.container.after_cancel(id)
+        self._showid = self._layoutid = None
+        self._spares = []
         # TBD: garbage collect internal structures, but not windows!
 
     def _resize(self, viewer):
         # called when the outer browser is resized (typically by the user)
         ##      print('_resize:', viewer)
-        self._autolayout_3()
+        self._schedule_layout()
 
     def _force_resize(self):
         # called when the stylesheet changes:
-        self._autolayout_2()
-        self._autolayout_3(force=True)
+        self._schedule_layout(force=True)
+
+    def _schedule_layout(self, force=False):
+        # a drag produces a stream of resize events; lay out once
+        # they have all been handled
+        self._forcelayout = self._forcelayout or force
+        if self._layoutid is None and not self._cleared:
+            self._layoutid = self.container.after_idle(self._layout)
+
+    def _layout(self):
+        self._layoutid = None
+        if self._cleared:
+            return
+        force = self._forcelayout
+        self._forcelayout = False
+        if force:
+            self._autolayout_2()
+        self._autolayout_3(force=force)
 
     def _notify(self, context):
         # receives notification when all readers for the shared
@@ -928,6 +1069,184 @@ def _get_height(tw):
     return y + h + border_y + 2
 
 
+# Font metrics, shared by all tables
+_fonts = {}                             # font description -> Font
+_linespaces = {}                        # font description -> pixels
+_extents = {}                           # (font description, text) -> pixels
+MAX_EXTENTS = 50000
+
+
+class _CellText:
+    """Measure the text of a table cell from font metrics.
+
+    Works from the (text, tags) runs that the cell's viewer inserted,
+    so the text widget never has to lay the cell out.  Each logical
+    line is broken into boxes: a word (which may span several runs)
+    and the blanks after it.  Lines are wrapped at blanks, the way Tk
+    wraps with wrap=word.
+    """
+
+    def __init__(self, viewer):
+        tw = viewer.text
+        self.tw = tw
+        self.priority = {tag: i for i, tag in enumerate(tw.tag_names())}
+        self.tag_options = {}
+        self.styles = {}
+        self.border_x = (tw.winfo_pixels(tw['padx'])
+                         + tw.winfo_pixels(tw['borderwidth'])
+                         + tw.winfo_pixels(tw['highlightthickness']))
+        self.border_y = (tw.winfo_pixels(tw['pady'])
+                         + tw.winfo_pixels(tw['borderwidth'])
+                         + tw.winfo_pixels(tw['highlightthickness']))
+        self.spacing = [tw.winfo_pixels(tw['spacing{}'.format(i)])
+                        for i in (1, 2, 3)]
+        self.default = self.get_style(())
+        self.lines = self.split_lines(viewer.runlog)
+        self.heights = {}               # width -> height
+
+    def get_options(self, tag):
+        options = self.tag_options.get(tag)
+        if options is None:
+            options = {}
+            for option in ('font', 'lmargin1', 'lmargin2', 'rmargin',
+                           'wrap'):
+                try:
+                    value = self.tw.tag_cget(tag, '-' + option)
+                except TclError:
+                    break               # not a tag of this widget
+                if value != '':
+                    options[option] = str(value)
+            self.tag_options[tag] = options
+        return options
+
+    def get_style(self, tags):
+        # -> (font description, Font, linespace, lmargin1, lmargin2,
+        #     rmargin, nowrap); options of higher priority tags win
+        style = self.styles.get(tags)
+        if style is not None:
+            return style
+        tw = self.tw
+        options = {'font': str(tw['font']), 'wrap': str(tw['wrap'])}
+        priority = self.priority.get
+        for tag in sorted(tags, key=lambda tag: priority(tag, -1)):
+            options.update(self.get_options(tag))
+        spec = options['font']
+        font = _fonts.get(spec)
+        if font is None:
+            font = _fonts[spec] = tkinter.font.Font(root=tw, font=spec)
+            _linespaces[spec] = font.metrics('linespace')
+        margins = [tw.winfo_pixels(options.get(option, 0))
+                   for option in ('lmargin1', 'lmargin2', 'rmargin')]
+        style = self.styles[tags] = (spec, font, _linespaces[spec],
+                                     *margins, options['wrap'] != WORD)
+        return style
+
+    def measure(self, style, text):
+        key = style[0], text
+        width = _extents.get(key)
+        if width is None:
+            if len(_extents) >= MAX_EXTENTS:
+                _extents.clear()
+            width = _extents[key] = style[1].measure(text)
+        return width
+
+    def split_lines(self, runs):
+        # -> list of (style of the first text, boxes) for each line;
+        # a box is [word width, blank width, linespace]
+        lines = []
+        boxes = []
+        first = None
+        linespace = 0
+        word = blank = wordspace = 0
+        pieces = []
+        for i in range(0, len(runs), 2):
+            style = self.get_style(runs[i + 1])
+            parts = runs[i].split('\n')
+            for j, text in enumerate(parts):
+                if j:
+                    pieces.append(None)         # end of line
+                if text or j:
+                    pieces.append((text, style))
+        pieces.append(None)
+        for piece in pieces:
+            if piece is None:
+                if word or not boxes:
+                    boxes.append([word, 0, wordspace or linespace
+                                  or self.default[2]])
+                lines.append((first or self.default, boxes))
+                boxes = []
+                first = None
+                linespace = word = wordspace = 0
+                continue
+            text, style = piece
+            if first is None and text:
+                first = style           # its margins count for the line
+            linespace = max(linespace, style[2])
+            if style[6]:
+                # no wrapping: the text is glued to the word so far
+                word = word + self.measure(style, text)
+                wordspace = max(wordspace, style[2])
+                continue
+            for m in _BOX_RE.finditer(text):
+                w, b = m.group(1, 2)
+                if w:
+                    word = word + self.measure(style, w)
+                    wordspace = max(wordspace, style[2])
+                if b:
+                    boxes.append([word, self.measure(style, b),
+                                  max(wordspace, style[2])])
+                    word = wordspace = 0
+        return lines
+
+    def widths(self):
+        """Return the minimum and maximum width of the cell."""
+        width_min = width_max = 0
+        for style, boxes in self.lines:
+            lmargin1, lmargin2, rmargin = style[3:6]
+            width = lmargin1 + rmargin
+            for word, blank, linespace in boxes:
+                width = width + word + blank
+                width_min = max(width_min,
+                                max(lmargin1, lmargin2) + word + rmargin)
+            width_max = max(width_max, width)
+        return (width_min + 2 * self.border_x,
+                width_max + 2 * self.border_x)
+
+    def height(self, width):
+        """Return the height of the cell when it is width pixels wide."""
+        height = self.heights.get(width)
+        if height is None:
+            if len(self.heights) >= MAX_LAYOUTS:
+                self.heights.clear()
+            height = self.heights[width] = self.wrap(width)
+        return height
+
+    def wrap(self, width):
+        spacing1, spacing2, spacing3 = self.spacing
+        available = width - 2 * self.border_x
+        height = 0
+        for style, boxes in self.lines:
+            lmargin1, lmargin2, rmargin = style[3:6]
+            right = available - rmargin
+            x = lmargin1
+            start = True
+            lineheight = 0
+            height = height + spacing1 + spacing3
+            for word, blank, linespace in boxes:
+                if not start and x + word > right:
+                    height = height + lineheight + spacing2
+                    x = lmargin2
+                    lineheight = 0
+                x = x + word + blank
+                start = False
+                lineheight = max(lineheight, linespace)
+            height = height + lineheight
+        return height + 2 * self.border_y
+
+
+_BOX_RE = re.compile(r'([^ \t]*)([ \t]*)')
+
+
 class ContainedText(AttrElem):
     """Base class for a text widget contained as a cell in a canvas.
     Both Captions and Cells are derived from this class.
@@ -936,6 +1255,7 @@ class ContainedText(AttrElem):
 
     def __init__(self, table, parentviewer, attrs):
         AttrElem.__init__(self, attrs)
+        self._table = table
         self._container = table.container
 
 ##      from profile import Profile
@@ -946,18 +1266,40 @@ class ContainedText(AttrElem):
 # globals(), locals())
 # Stats(p).strip_dirs().sort_stats('time').print_stats(5)
 
-        self._viewer = Viewer(master=table.container,
-                              context=parentviewer.context,
-                              scrolling=False,
-                              stylesheet=parentviewer.stylesheet,
-                              parent=parentviewer)
-        if not parentviewer.find_parentviewer():
-            self._viewer.RULE_WIDTH_MAGIC = self._viewer.RULE_WIDTH_MAGIC - 6
-        # for callback notification
-        self._fw = self._viewer.frame
-        self._tw = self._viewer.text
+        self._set_viewer(self.get_viewer(table))
         self._tw.config(highlightthickness=0)
         self._embedheight = 0
+        # the runs of text are measured, unless there are windows
+        self._viewer.runlog = []
+        self._metrics = None
+        # a cell that is only text can give up its widgets and keep
+        # just the runs, see hide() and show()
+        self._runs = None
+        self._tag = None
+        self._x = self._y = 0
+        self._width = 0
+        self._height = None
+        self._padding = 0
+
+    def get_viewer(self, table):
+        return table.new_viewer()
+
+    def _set_viewer(self, viewer):
+        self._viewer = viewer
+        # for callback notification
+        if viewer:
+            self._fw = viewer.frame
+            self._tw = viewer.text
+        else:
+            self._fw = self._tw = None
+
+    def configure_widgets(self):
+        # also used to set up a recycled viewer in show()
+        self._tw.config(highlightthickness=0)
+
+    def decorate(self):
+        # set the style of the contained text
+        pass
 
     def new_formatter(self):
         formatter = AbstractFormatter(self._viewer)
@@ -970,7 +1312,14 @@ class ContainedText(AttrElem):
 
     def unfreeze(self): self._viewer.unfreeze()
 
-    def close(self): self._viewer.close()
+    def close(self):
+        if self._viewer:
+            self._viewer.close()
+
+    def get_text(self):
+        if self._viewer:
+            return self._tw.get(1.0, 'end - 1 c')
+        return ''.join(self._runs[::2])
 
     def maxwidth(self):
         return self._maxwidth           # not useful until after finish()
@@ -979,11 +1328,23 @@ class ContainedText(AttrElem):
         return self._minwidth           # likewise
 
     def height(self):
+        if self._metrics:
+            return max(self._embedheight,
+                       self._metrics.height(self._width) + 2)
         return max(self._embedheight, _get_height(self._tw))
 
+    def measure(self):
+        # -> _CellText, or None if the text widget has to be probed
+        viewer = self._viewer
+        if viewer.subwindows or viewer.rules or viewer.runlog is None:
+            return None
+        return _CellText(viewer)
+
     def recalc(self):
         # recalculate width and height upon notification of completion
         # of all context's readers (usually image readers)
+        if self._runs is not None:
+            return 0                    # only text, nothing to wait for
         min_nonaligned = self._minwidth
         maxwidth = self._maxwidth
         embedheight = self._embedheight
@@ -1029,11 +1390,23 @@ class ContainedText(AttrElem):
                            int(padding[:-1]) // 200)
             except ValueError:
                 padding = 0
-        tw['padx'] = padding
+        tw['padx'] = self._padding = padding
         # TBD: according to the W3C table spec, minwidth should really
         # be max(min_left + min_right, min_nonaligned).  Also note
         # that minwidth is recalculated by minwidth() call
-        self._minwidth, self._maxwidth = _get_widths(self._tw)
+        self._metrics = self.measure()
+        if self._metrics:
+            width_min, width_max = self._metrics.widths()
+            self._minwidth = float(width_min) + 2
+            self._maxwidth = float(width_max) + 2
+        else:
+            self._minwidth, self._maxwidth = _get_widths(self._tw)
+        viewer = self._viewer
+        if self._metrics and not viewer.targets:
+            self._runs = viewer.runlog
+        viewer.runlog = None
+        self._width = self._maxwidth
+        self.decorate()
         # first approximation of height.  this is the best we can do
         # without forcing an update_idletasks() fireworks display
         tw['height'] = _get_linecount(tw) + 1
@@ -1047,21 +1420,58 @@ class ContainedText(AttrElem):
             width=self._maxwidth,
             height=fw['height'])
 
-    def situate(self, x=0, y=0, width=None, height=None):
-        # canvas.move() deals in relative positioning, but we want
-        # absolute coordinates
-        xdelta = x - self._x
-        ydelta = y - self._y
-        self._x = x
-        self._y = y
-        self._container.move(self._tag, xdelta, ydelta)
-        if width is not None and height is not None:
-            self._container.itemconfigure(self._tag,
-                                          width=width, height=height)
-        elif width is not None:
-            self._container.itemconfigure(self._tag, width=width)
-        else:
-            self._container.itemconfigure(self._tag, height=height)
+    def situate(self, x=None, y=None, width=None, height=None):
+        # only the parts of the geometry that changed are passed on to
+        # the canvas; arguments left out stay as they are
+        moved = ((x is not None and x != self._x)
+                 or (y is not None and y != self._y))
+        if x is not None:
+            self._x = x
+        if y is not None:
+            self._y = y
+        options = {}
+        if width is not None and width != self._width:
+            self._width = options['width'] = width
+        if height is not None and height != self._height:
+            self._height = options['height'] = height
+        if self._tag is None:
+            return                      # hidden, see show()
+        if moved:
+            self._container.coords(self._tag, self._x, self._y)
+        if options:
+            self._container.itemconfigure(self._tag, **options)
+
+    def overlaps(self, left, top, right, bottom):
+        return (self._x < right and self._x + self._width > left
+                and self._y < bottom and self._y + (self._height or 0) > top)
+
+    def hide(self):
+        """Give the viewer of a cell that is only text back to the table."""
+        if self._runs is None or self._tag is None:
+            return
+        self._container.delete(self._tag)
+        self._tag = None
+        viewer = self._viewer
+        self._set_viewer(None)
+        self._table.release_viewer(viewer)
+
+    def show(self):
+        """Give a hidden cell a viewer again, filled from its runs."""
+        if self._runs is None or self._tag is not None:
+            return
+        self._set_viewer(self._table.get_viewer())
+        self.configure_widgets()
+        self._tw['padx'] = self._padding
+        viewer = self._viewer
+        viewer.unfreeze()
+        viewer.replay_runs(self._runs)
+        self.decorate()
+        viewer.freeze()
+        options = {'width': self._width}
+        if self._height is not None:
+            options['height'] = self._height
+        self._tag = self._container.create_window(
+            self._x, self._y, window=self._fw, anchor=NW, **options)
 
 
 class Caption(ContainedText):
@@ -1076,11 +1486,9 @@ class Caption(ContainedText):
                 ['top', 'bottom', 'left', 'right']) or 'top'
         self.align = self.attribute('align', conv=conv_align)
 
-    def finish(self, table, padding=0):
-        ContainedText.finish(self, table, padding=0)
-        # set the style of the contained text
-        self._viewer.text.tag_add('contents', 1.0, END)
-        self._viewer.text.tag_config('contents', justify=CENTER)
+    def decorate(self):
+        self._tw.tag_add('contents', 1.0, END)
+        self._tw.tag_config('contents', justify=CENTER)
 
 
 class Cell(ContainedText):
@@ -1099,8 +1507,7 @@ class Cell(ContainedText):
                 relief = FLAT
             else:
                 relief = SUNKEN
-        self._tw.config(relief=FLAT, borderwidth=0)
-        self._fw.config(relief=relief, borderwidth=1)
+        self._relief = relief
         # horizontal alignment
         halign = self.attribute('align', conv=conv_halign,
                                 default=table.lastbody.trows[-1].Ahalign)
@@ -1111,10 +1518,6 @@ class Cell(ContainedText):
         valign = self.attribute('valign', conv=conv_valign,
                                 default=table.lastbody.trows[-1].Avalign)
         self.Avalign = valign
-        if valign == 'middle':
-            self._tw.pack(fill=X)
-        elif valign == 'bottom':
-            self._tw.pack(fill=X, anchor=S)
         # background color
         rowcolor = table.lastbody.trows[-1].Abgcolor
         if parser.context.app.prefs.GetBoolean('parsing-html', 'honor-colors'):
@@ -1157,19 +1560,39 @@ class Cell(ContainedText):
             self.rowspan = 1
         if self.colspan < 0:
             self.colspan = 1
+        self.configure_widgets()
+
+    def get_viewer(self, table):
+        return table.get_viewer()
+
+    def configure_widgets(self):
+        ContainedText.configure_widgets(self)
+        self._tw.config(relief=FLAT, borderwidth=0)
+        self._fw.config(relief=self._relief, borderwidth=1)
+        if self.Avalign == 'middle':
+            self._tw.pack(fill=X, anchor=CENTER)
+        elif self.Avalign == 'bottom':
+            self._tw.pack(fill=X, anchor=S)
+        else:
+            self._tw.pack(fill=BOTH, anchor=CENTER)
+        if self.Abgcolor:
+            self._tw.config(background=self.Abgcolor)
+            self._fw.config(background=self.Abgcolor)
+        else:
+            self._tw.config(background=self._viewer.default_bg)
 
     def init_style(self):
         pass
 
     def __repr__(self):
-        # return '<{}>"{}"'.format(id(self), self._tw.get(1.0, END)[:-1])
-        return '"{}"'.format(self._tw.get(1.0, END)[:-1])
+        return '"{}"'.format(self.get_text())
 
     def is_empty(self):
-        return not self._tw.get(1.0, 'end - 1 c')
+        return not self.get_text()
 
     def finish(self, table, padding=0):
         ContainedText.finish(self, table, padding=self.cellpadding)
+        table.cell_finished(self)
 
 
 class TDCell(Cell):
@@ -1182,8 +1605,7 @@ class THCell(Cell):
         # TBD: this should be extracted from stylesheets and/or preferences
         self._parser.get_formatter().push_font((None, None, False, None))
 
-    def finish(self, table):
-        Cell.finish(self, table)
+    def decorate(self):
         self._tw.tag_add('contents', 1.0, END)
         self._tw.tag_config('contents', justify=CENTER)
 
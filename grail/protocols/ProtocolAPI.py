@@ -28,6 +28,16 @@ from .. import grailutil
 # list of valid scheme environment variables for proxies
 VALID_PROXIES = ('http_proxy', 'ftp_proxy')
 
+#
+# priority classes, passed in the '.priority' parameter; the socket
+# queue serves waiting requests of a lower number first
+PRIORITY_DOCUMENT = 0                   # top-level document
+PRIORITY_FRAME = 1                      # frames and style sheets
+PRIORITY_IMAGE = 2                      # visible images
+PRIORITY_OFFSCREEN = 3                  # images out of view
+PRIORITY_PREFETCH = 4
+PRIORITY_NAMES = ('document', 'frame', 'image', 'offscreen', 'prefetch')
+
 
 def protocol_joiner(scheme):
     scheme = scheme.lower()
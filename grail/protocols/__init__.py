@@ -13,6 +13,15 @@ protocol_joiner(scheme)
         return a function to implement relative URL joining according
         to the scheme; or None if no such function exists.
 
+Exported constants:
+
+PRIORITY_DOCUMENT, PRIORITY_FRAME, PRIORITY_IMAGE, PRIORITY_OFFSCREEN,
+PRIORITY_PREFETCH
+        values for the '.priority' parameter, which tells network
+        protocols how urgent a request is.
+
 """
 
 from .ProtocolAPI import protocol_access, protocol_joiner
+from .ProtocolAPI import PRIORITY_DOCUMENT, PRIORITY_FRAME, PRIORITY_IMAGE, \
+    PRIORITY_OFFSCREEN, PRIORITY_PREFETCH, PRIORITY_NAMES
@@ -2,10 +2,11 @@
 
 XXX Main deficiencies:
 
-- poll*() always returns ready
+- poll*() always returns ready once the host name is known
 - should read the headers more carefully (no blocking)
 - (could even *write* the headers more carefully)
-- should poll the connection making part too
+- should poll the connection making part too (the host name lookup
+  is done in the background, but the FTP session itself blocks)
 - no GC of ftp cache entries
 - should reuse ftp cache entries for same server by using cdup/cd
 - if a file retrieval returns error 550 it is retried as directory listing
@@ -14,13 +15,14 @@ XXX Main deficiencies:
 
 
 import re
+import socket
 
 import ftplib
 from urllib.parse import unquote, splithost, splitport, splituser, \
     splitpasswd, splitattr, splitvalue, quote
 from urllib.parse import urljoin
 from .. import grailutil
-import socket
+from .. import dnscache
 import html
 from xml.sax import saxutils
 
@@ -28,6 +30,7 @@ app = grailutil.get_grailapp()          # app.guess_type(url)
 
 
 # Stages
+WAIT = 'WAIT'                           # looking up the server's address
 META = 'META'
 DATA = 'DATA'
 EOF = 'EOF'
@@ -74,6 +77,9 @@ ftpcache = {}                           # XXX Ouch!  A global!
 
 class ftp_access:
 
+    # milliseconds between checks for the result of a name lookup
+    lookup_interval = 20
+
     def __init__(self, url, method, params):
         assert method == 'GET'
         netloc, path = splithost(url)
@@ -85,7 +91,6 @@ class ftp_access:
             user, passwd = splitpasswd(user)
         else:
             passwd = None
-        host = socket.gethostbyname(host)
         if port:
             try:
                 port = int(port)
@@ -113,42 +118,120 @@ class ftp_access:
                 type = 'i'
         if dirs and not dirs[0]:
             dirs = dirs[1:]
-        key = (user, host, port, '/'.join(dirs))
         self.debuglevel = 0
+        for attr in attrs:
+            [attr, value] = map(str.lower, splitvalue(attr))
+            if attr == 'type' and value in ('a', 'i', 'd'):
+                type = value
+            elif attr == 'debug':
+                try:
+                    self.debuglevel = int(value)
+                except ValueError:
+                    pass
+        self.host = host
+        self.port = port
+        self.args = (user, passwd, dirs, file, type)
+        self.sock = None
+        self.cand = None
+        self.isdir = False
+        self.reply = None
+        self.timer = None
+        self.reader_callback = None
+        self.state = WAIT
+        self.lookup()
+
+    def register_reader(self, reader_callback, reader_poll):
+        if self.state == WAIT:
+            self.reader_callback = reader_callback
+        else:
+            reader_callback()
+
+    def start_reader(self):
+        callback = self.reader_callback
+        self.reader_callback = None
+        if callback:
+            callback()
+
+    def lookup(self):
+        """Wait for the address of the server without blocking."""
+        self.timer = None
+        try:
+            addresses = dnscache.resolve(self.host, self.port)
+        except OSError as err:
+            self.lookup_failed(err)
+            return
+        if addresses is None:
+            self.timer = app.root.after(self.lookup_interval, self.lookup)
+        else:
+            self.open(addresses)
+
+    def lookup_now(self):
+        if self.timer:
+            app.root.after_cancel(self.timer)
+            self.timer = None
         try:
-            ftpcache.setdefault(key, [])
-            for attr in attrs:
-                [attr, value] = map(str.lower, splitvalue(attr))
-                if attr == 'type' and value in ('a', 'i', 'd'):
-                    type = value
-                elif attr == 'debug':
-                    try:
-                        self.debuglevel = int(value)
-                    except ValueError:
-                        pass
-            candidates = ftpcache[key]
+            addresses = dnscache.resolve_now(self.host, self.port)
+        except OSError as err:
+            self.lookup_failed(err)
+            return
+        self.open(addresses)
+
+    def lookup_failed(self, err):
+        self.fail("Cannot connect to {}: {}".format(
+            self.host, err.strerror or err), err.errno)
+
+    def fail(self, errmsg, errcode=None):
+        """Report a failed lookup or FTP command as the reply."""
+        self.reply = errcode or 0, errmsg, {}
+        self.state = META
+        self.start_reader()
+
+    def open(self, addresses):
+        """Start the transfer once the server's address is known."""
+        for family, socktype, proto, canonname, sockaddr in addresses:
+            if family == socket.AF_INET:
+                break
+        host = sockaddr[0]
+        user, passwd, dirs, file, type = self.args
+        key = (user, host, self.port, '/'.join(dirs))
+        try:
+            candidates = ftpcache.setdefault(key, [])
             for cand in candidates:
                 if not cand.busy():
                     break
             else:
                 cand = ftpwrapper(user, passwd,
-                                  host, port, dirs, self.debuglevel)
+                                  host, self.port, dirs, self.debuglevel)
                 candidates.append(cand)
             # XXX Ought to clean the cache every once in a while
             self.cand = cand
             self.sock, self.isdir = cand.retrfile(file, type)
             self.content_length = cand.content_length
-        except ftplib.all_errors as msg:
-            raise IOError('ftp error', msg)
+        except ftplib.all_errors as err:
+            self.fail("ftp error: {}".format(err.args[-1] if err.args
+                                             else err))
+            return
         self.state = META
+        self.start_reader()
 
     def pollmeta(self):
+        if self.state == WAIT:
+            if self.timer:
+                # check now, so polling works without the event loop
+                app.root.after_cancel(self.timer)
+                self.lookup()
+            if self.state == WAIT:
+                return "looking up host name", False
         assert self.state == META
         return "Ready", True
 
     def getmeta(self):
+        if self.state == WAIT:
+            self.lookup_now()
         assert self.state == META
         self.state = DATA
+        if self.reply:
+            return self.reply
         headers = {}
         if self.isdir:
             if self.url and not self.url.endswith('/'):
@@ -173,6 +256,9 @@ class ftp_access:
             self.state = DONE
             return b""
         assert self.state == DATA
+        if not self.sock:
+            self.state = DONE
+            return b""
         data = self.sock.recv(maxbytes)
         if self.debuglevel > 4:
             print("*data*", repr(data))
@@ -246,9 +332,14 @@ class ftp_access:
     listing_pattern = LISTING_PATTERN
 
     def fileno(self):
-        return self.sock.fileno()
+        if self.sock:
+            return self.sock.fileno()
+        return -1
 
     def close(self):
+        if self.timer:
+            app.root.after_cancel(self.timer)
+            self.timer = None
         sock = self.sock
         cand = self.cand
         self.sock = None
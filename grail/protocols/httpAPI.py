@@ -10,23 +10,37 @@ XXX Main deficiencies:
 - poll*() always returns ready
 - should read the headers more carefully (no blocking)
 - (could even *write* the headers more carefully)
-- should poll the connection making part too
+
+Requests are sent as HTTP/1.1. The end of each response body is found
+from its Content-Length or its chunked transfer coding (see
+ChunkedDecoder), so connections are kept alive and reused for the
+next request to the same server (see ConnectionPool).
+
+Host names are looked up by the dnscache module on worker threads,
+and connections are made without blocking; the Tk event loop is told
+to call back when the name is known and when the socket is writable.
 
 """
 
 
 import http.client
-from urllib.parse import splithost
+from urllib.parse import splithost, splitport
 import email.parser
+import errno
 from .. import grailutil
+from .. import dnscache
 import select
 from .. import Reader
+from .ProtocolAPI import PRIORITY_DOCUMENT
+import os
 import re
 import socket
+import time
+import tkinter
 from .. import GRAILVERSION
 
 
-replypat = br'HTTP/1\.[0-9.]+[ \t]+([0-9][0-9][0-9])(.*)'
+replypat = br'HTTP/1\.([0-9.]+)[ \t]+([0-9][0-9][0-9])(.*)'
 replyprog = re.compile(replypat)
 
 
@@ -35,8 +49,9 @@ endofheaders = re.compile(br'\n[ \t]*\r?\n')
 
 
 # Stages
-# there are now five stages
-WAIT = 'wait'  # waiting for a socket
+# there are now six stages
+WAIT = 'wait'  # waiting for a socket or the server's address
+CONNECT = 'connect'  # connecting to the server
 META = 'meta'
 DATA = 'data'
 DONE = 'done'
@@ -55,18 +70,181 @@ def simplereply(url):
     return 200, "OK", headers
 
 
+class ChunkedDecoder:
+
+    """Incremental decoder for the chunked transfer coding.
+
+    feed() takes any piece of the encoded body and returns the data
+    decoded from it so far. Once the last chunk and the trailer have
+    been read, done is set and any bytes that followed them are kept
+    in extra.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.state = 'size'
+        self.size = 0
+        self.done = False
+        self.extra = b''
+
+    def feed(self, data):
+        if self.done:
+            self.extra = self.extra + data
+            return b''
+        buf = self.buffer
+        buf.extend(data)
+        out = bytearray()
+        pos = 0
+        while not self.done:
+            if self.state == 'data':
+                n = min(self.size, len(buf) - pos)
+                out.extend(buf[pos:pos + n])
+                pos = pos + n
+                self.size = self.size - n
+                if self.size:
+                    break
+                self.state = 'crlf'
+                continue
+            i = buf.find(b'\n', pos)
+            if i < 0:
+                break
+            line = bytes(buf[pos:i]).strip()
+            pos = i + 1
+            if self.state == 'crlf':
+                # the line ending after the data of a chunk
+                self.state = 'size'
+            elif self.state == 'trailer':
+                if not line:
+                    self.done = True
+                    self.extra = bytes(buf[pos:])
+                    pos = len(buf)
+            else:
+                size = line.split(b';', 1)[0]
+                try:
+                    self.size = int(size, 16)
+                except ValueError:
+                    raise IOError("bad chunk size: {!r}".format(size))
+                self.state = 'data' if self.size else 'trailer'
+        del buf[:pos]
+        return bytes(out)
+
+
+class ConnectionPool:
+
+    """Idle persistent connections, keyed by (scheme, host, port).
+
+    A connection is only put back after the body of its last response
+    has been read completely. Connections idle for more than
+    idle_timeout seconds, or that became readable while idle (which
+    means the server has closed them), are dropped. The callers keep
+    the idle connections and the open ones together within the
+    application's socket limit, closing the oldest idle ones first.
+    """
+
+    idle_timeout = 30.0
+    max_per_host = 4
+
+    def __init__(self):
+        self.idle = {}
+
+    def get(self, key):
+        """Return an idle connection for key, or None."""
+        self.expire()
+        conns = self.idle.get(key, [])
+        while conns:
+            h, stamp = conns.pop()
+            if self.alive(h):
+                return h
+            h.close()
+        return None
+
+    def put(self, key, h, limit):
+        """Keep h for reuse, with at most limit idle connections."""
+        self.expire()
+        conns = self.idle.setdefault(key, [])
+        if len(conns) >= self.max_per_host:
+            h.close()
+        else:
+            conns.append((h, time.time()))
+        self.trim(limit)
+
+    def trim(self, limit):
+        """Close the oldest idle connections until limit are left."""
+        total = sum(map(len, self.idle.values()))
+        while total > limit:
+            key = min(self.idle, key=lambda key: self.idle[key][0][1])
+            conns = self.idle[key]
+            conns.pop(0)[0].close()
+            if not conns:
+                del self.idle[key]
+            total = total - 1
+
+    def expire(self):
+        t = time.time() - self.idle_timeout
+        for key, conns in list(self.idle.items()):
+            while conns and conns[0][1] < t:
+                conns.pop(0)[0].close()
+            if not conns:
+                del self.idle[key]
+
+    def alive(self, h):
+        if not h.sock:
+            return False
+        try:
+            return not select.select([h.sock], [], [], 0)[0]
+        except (select.error, ValueError):
+            return False
+
+    def close(self):
+        for conns in self.idle.values():
+            for h, stamp in conns:
+                h.close()
+        self.idle.clear()
+
+
+connection_pool = ConnectionPool()
+
+
 class http_access:
 
+    connection_class = http.client.HTTPConnection
+    scheme = 'http'
+    # milliseconds between checks for the result of a name lookup
+    lookup_interval = 20
+
     def __init__(self, resturl, method, params, data=None):
         self.app = grailutil.get_grailapp()
         self.args = (resturl, method, params, data)
         self.state = WAIT
         self.h = None
+        self.has_socket = False
+        self.reply = None
+        self.timer = None
+        self.sock = None
+        self.watched = None
+        self.watchmask = None
+        self.watchcallback = None
         self.reader_callback = None
-        self.app.sq.request_socket(self, self.open)
+        self.reader_poll = None
+        self.notify_pending = False
+        self.spent = None
+        self.app.sq.request_socket(self, self.open,
+                                   self.socket_host(resturl),
+                                   params.get('.priority', PRIORITY_DOCUMENT))
 
-    def register_reader(self, reader_callback, ignore):
-        if self.state == WAIT:
+    def socket_host(self, resturl):
+        """Return the name the socket queue counts connections under."""
+        if isinstance(resturl, tuple):
+            host = resturl[0]
+        else:
+            host = splithost(resturl)[0]
+        return (host or '').rpartition('@')[2].lower()
+
+    def register_reader(self, reader_callback, reader_poll):
+        # reader_poll is called when data is ready that the socket
+        # won't signal, e.g. at the end of a kept-alive response
+        self.reader_poll = reader_poll
+        if self.state in (WAIT, CONNECT):
             self.reader_callback = reader_callback
         else:
             # we've been waitin' fer ya
@@ -74,6 +252,7 @@ class http_access:
 
     def open(self):
         assert self.state == WAIT
+        self.has_socket = True
         resturl, method, params, data = self.args
         if data:
             assert method == "POST"
@@ -93,48 +272,278 @@ class http_access:
         else:
             host = user_passwd
             auth = None
-        self.h = http.client.HTTPConnection(host)
-
-        # Grail does not currently seem to handle HTTP 1.1's persistent
-        # connections, nor chunked transfer encoding
-        self.h._http_vsn = 10
-        self.h._http_vsn_str = 'HTTP/1.0'
+        hostname, port = splitport(host)
+        if port:
+            try:
+                port = int(port)
+            except ValueError:
+                raise IOError("nonnumeric port: {}".format(port))
+        else:
+            port = None
+        self.hostport = hostname, port
+        port = port or self.connection_class.default_port
+        self.address = hostname, port   # what is looked up and connected to
+        self.key = (self.scheme, hostname.lower(), port)
 
-        self.h.putrequest(method, self.selector)
-        self.h.putheader('User-agent', GRAILVERSION)
+        headers = ['{} {} HTTP/1.1'.format(method, self.selector),
+                   'User-agent: {}'.format(GRAILVERSION)]
         if auth:
-            self.h.putheader('Authorization', 'Basic {}'.format(auth))
+            headers.append('Authorization: Basic {}'.format(auth))
         if 'host' not in params:
-            self.h.putheader('Host', host)
+            headers.append('Host: {}'.format(host))
         if 'accept-encoding' not in params:
             encodings = Reader.get_content_encodings()
             if encodings:
                 encodings.sort()
-                self.h.putheader('Accept-Encoding', ", ".join(encodings))
+                headers.append('Accept-Encoding: {}'.format(
+                    ", ".join(encodings)))
         for key, value in params.items():
             if not key.startswith('.'):
-                self.h.putheader(key, value)
-        self.h.putheader('Accept', '*/*')
-        self.h.endheaders()
-        if data:
-            self.h.send(data)
+                headers.append('{}: {}'.format(key, value))
+        headers.append('Accept: */*')
+        self.method = method
+        self.request = ('\r\n'.join(headers) + '\r\n\r\n').encode('latin-1')
+        self.postdata = data
+
+        # never send a POST over a recycled connection: if the server
+        # has dropped it, we could not tell whether to send it again
+        if not data:
+            self.h = connection_pool.get(self.key)
+        self.reused = self.h is not None
+        if self.reused:
+            self.connected()
+        else:
+            # make room for the new socket among the idle ones
+            sq = self.app.sq
+            connection_pool.trim(sq.max - sq.open)
+            self.h = self.make_connection()
+            self.lookup()
+
+    def make_connection(self):
+        return self.connection_class(*self.hostport)
+
+    def lookup(self):
+        """Wait for the address of the server without blocking."""
+        self.timer = None
+        try:
+            addresses = dnscache.resolve(*self.address)
+        except OSError as err:
+            self.fail(err)
+            return
+        if addresses is None:
+            self.timer = self.app.root.after(self.lookup_interval,
+                                             self.lookup)
+        else:
+            self.addresses = list(addresses)
+            self.connect()
+
+    def connect(self):
+        """Start connecting to the next address of the server."""
+        family, type, proto, canonname, sockaddr = self.addresses.pop(0)
+        try:
+            sock = socket.socket(family, type, proto)
+        except OSError as err:
+            self.connect_failed(err)
+            return
+        sock.setblocking(False)
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self.connect_failed(OSError(err, os.strerror(err)))
+            return
+        self.sock = sock
+        self.state = CONNECT
+        self.watch(tkinter.WRITABLE, self.connect_ready)
+
+    def connect_ready(self, *args):
+        self.unwatch()
+        sock = self.sock
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.sock = None
+            sock.close()
+            self.connect_failed(OSError(err, os.strerror(err)))
+        else:
+            self.secure(sock)
+
+    def connect_failed(self, err):
+        if self.addresses:
+            self.connect()
+        else:
+            self.fail(err)
+
+    def secure(self, sock):
+        """Set up the connection layer; https_access adds TLS here."""
+        self.connected(sock)
+
+    def watch(self, mask, callback):
+        self.unwatch()
+        self.watched = self.sock.fileno()
+        self.watchmask = mask
+        self.watchcallback = callback
+        self.app.root.createfilehandler(self.watched, mask, callback)
+
+    def unwatch(self):
+        if self.watched is not None:
+            self.app.root.deletefilehandler(self.watched)
+            self.watched = None
+            self.watchmask = self.watchcallback = None
+
+    def connected(self, sock=None):
+        """Send the request and start waiting for the response."""
+        if sock is not None:
+            sock.setblocking(True)
+            self.h.sock = sock
+            self.sock = None
         self.readahead = bytearray()
+        self.recvbuf = bytearray()      # reused by fill()
         self.state = META
         self.line1seen = False
         self.reply = None
-        if self.reader_callback:
-            self.reader_callback()
+        self.remaining = None
+        self.decoder = None
+        self.persistent = False
+        self.send_request()
+        self.start_reader()
+
+    def start_reader(self):
+        # the reader is started once, whether or not we connected
+        callback = self.reader_callback
+        self.reader_callback = None
+        if callback:
+            callback()
+
+    def fail(self, err):
+        """Report a failed lookup or connect as the reply."""
+        self.stop_connecting()
+        self.h = None
+        self.return_socket()
+        self.readahead = bytearray()
+        self.remaining = None
+        self.decoder = None
+        self.persistent = False
+        self.reply = (err.errno or 0,
+                      "Cannot connect to {}: {}".format(
+                          self.hostport[0], err.strerror or err),
+                      {})
+        self.state = META
+        self.start_reader()
+
+    def stop_connecting(self):
+        if self.timer:
+            self.app.root.after_cancel(self.timer)
+            self.timer = None
+        self.unwatch()
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def connect_now(self):
+        """Finish connecting, waiting for each step if necessary."""
+        if self.state == WAIT:
+            if self.timer:
+                self.app.root.after_cancel(self.timer)
+                self.timer = None
+            try:
+                self.addresses = list(dnscache.resolve_now(*self.address))
+            except OSError as err:
+                self.fail(err)
+                return
+            self.connect()
+        # connect() and https_access.handshake() wait for the socket
+        # with watch(); do the waiting here instead of in the event loop
+        while self.watched is not None:
+            fd, mask = self.watched, self.watchmask
+            readable = [fd] if mask & tkinter.READABLE else []
+            writable = [fd] if mask & tkinter.WRITABLE else []
+            select.select(readable, writable, [])
+            self.watchcallback()
+
+    def send_request(self):
+        try:
+            self.h.send(self.request)
+            if self.postdata:
+                self.h.send(self.postdata)
+        except OSError:
+            if not self.reused:
+                raise
+            self.reconnect()
+
+    def reconnect(self):
+        """Send the request again over a new connection.
+
+        Used when the server has closed a recycled connection before
+        sending any response.
+        """
+        self.h.close()
+        self.h = self.make_connection()
+        self.reused = False
+        self.state = WAIT
+        self.connect_now()
+
+    def release(self):
+        """Stop reading from the connection after the response was read.
+
+        The connection and its socket are only given up by close(),
+        since the reader may still have a file handler on the socket.
+        """
+        if self.h:
+            self.spent = self.h
+            self.h = None
+
+    def recycle(self, h):
+        """Pool or close a spent connection and give up its socket."""
+        if self.persistent:
+            # the socket of this request is still counted as open
+            sq = self.app.sq
+            connection_pool.put(self.key, h, sq.max - sq.open + 1)
+        else:
+            h.close()
+        self.return_socket()
+
+    def return_socket(self):
+        if self.has_socket:
+            self.has_socket = False
+            self.app.sq.return_socket(self)
 
     def close(self):
+        self.stop_connecting()
         if self.h:
+            # the response was not read completely
             self.h.close()
-        if self.state != CLOS:
+        if self.spent:
+            # the reader may close us before it removes its file
+            # handler; wait until it has before the socket is reused
+            self.app.root.after_idle(self.recycle, self.spent)
+            self.spent = None
+        elif self.has_socket:
+            self.return_socket()
+        elif self.state == WAIT:
             self.app.sq.return_socket(self)
-            self.state = CLOS
+        self.state = CLOS
         self.h = None
+        self.reader_poll = None
+
+    def notify_reader(self):
+        if self.reader_poll and not self.notify_pending:
+            self.notify_pending = True
+            self.app.root.after_idle(self.run_reader_poll)
+
+    def run_reader_poll(self):
+        self.notify_pending = False
+        if self.reader_poll and self.state == DATA:
+            self.reader_poll()
 
     def pollmeta(self, timeout=0):
+        if self.state == WAIT:
+            if self.has_socket:
+                return "looking up host name", False
+            return "waiting for socket", False
+        if self.state == CONNECT:
+            return "connecting to server", False
         assert self.state == META
+        if self.reply:
+            return "received server response", True
 
         sock = self.h.sock
         try:
@@ -142,36 +551,129 @@ class http_access:
                 return "waiting for server response", False
         except select.error as msg:
             raise IOError(msg) from msg
-        new = sock.recv(1024)
+        try:
+            new = sock.recv(1024)
+        except OSError:
+            if not (self.reused and not self.line1seen
+                    and not self.readahead):
+                raise
+            new = b''
         if not new:
+            if self.reused and not self.line1seen and not self.readahead:
+                self.reconnect()
+                return "waiting for server response", False
             self.reply = simplereply(self.selector)
             return "EOF in server response", True
         self.readahead.extend(new)
-        if b'\n' not in new:
-            return "receiving server response", False
-        if not self.line1seen:
-            self.line1seen = True
-            line, rest = self.readahead.split(b'\n', 1)
-            m = replyprog.match(line)
+        return self.parse_reply()
+
+    def parse_reply(self):
+        while True:
+            if not self.line1seen:
+                if b'\n' not in self.readahead:
+                    return "receiving server response", False
+                self.line1seen = True
+                line, rest = self.readahead.split(b'\n', 1)
+                m = replyprog.match(line)
+                if not m:
+                    # Not an HTTP/1.x response.  Fall back to HTTP/0.9.
+                    self.reply = simplereply(self.selector)
+                    return "received non-HTTP/1.x server response", True
+                self.minor, self.errcode, self.errmsg = m.group(1, 2, 3)
+                self.errcode = int(self.errcode)
+                self.errmsg = self.errmsg.decode('latin-1').strip()
+                # keep the newline, so that endofheaders also finds
+                # the end of an empty header section
+                self.readahead = bytearray(b'\n') + rest
+            m = endofheaders.search(self.readahead)
             if not m:
-                # Not an HTTP/1.0 response.  Fall back to HTTP/0.9.
-                self.reply = simplereply(self.selector)
-                return "received non-HTTP/1.0 server response", True
-            self.errcode, self.errmsg = m.group(1, 2)
-            self.errcode = int(self.errcode)
-            self.errmsg = self.errmsg.decode('latin-1').strip()
-            self.readahead = rest
-        m = endofheaders.search(self.readahead)
-        if m and m.start() >= 0:
-            headers = self.readahead[:m.end()].decode('latin-1')
+                return "receiving server response", False
+            headers = self.readahead[1:m.end()].decode('latin-1')
             del self.readahead[:m.end()]
+            if 100 <= self.errcode < 200:
+                # an interim response; the real one follows
+                self.line1seen = False
+                continue
             parser = email.parser.Parser()
             headers = parser.parsestr(headers, headersonly=True)
             self.reply = self.errcode, self.errmsg, headers
+            self.check_persistence(headers)
             return "received server response", True
-        return "receiving server response", False
+
+    def check_persistence(self, headers):
+        """Find out where the body ends and if the connection is reusable.
+        """
+        tokens = [token.strip().lower()
+                  for token in headers.get('connection', '').split(',')]
+        if self.minor == b'0':
+            self.persistent = 'keep-alive' in tokens
+        else:
+            self.persistent = 'close' not in tokens
+        coding = headers.get('transfer-encoding', '').lower()
+        raw = bytes(self.readahead)
+        self.readahead = bytearray()
+        if self.method == 'HEAD' or self.errcode in (204, 304):
+            self.remaining = 0
+        elif 'chunked' in coding:
+            self.decoder = ChunkedDecoder()
+        else:
+            try:
+                self.remaining = int(headers.get('content-length'))
+            except (TypeError, ValueError):
+                self.remaining = None
+            if self.remaining is None or self.remaining < 0:
+                # the body ends when the server closes the connection
+                self.remaining = None
+                self.persistent = False
+        if self.remaining == 0:
+            if raw:
+                self.persistent = False
+            self.release()
+        elif raw:
+            self.frame(raw)
+
+    def frame(self, raw):
+        """Add body data read from the socket to the readahead buffer.
+
+        Strips the chunked transfer coding and gives up the connection
+        as soon as the end of the body is seen.
+        """
+        if self.decoder:
+            self.readahead.extend(self.decoder.feed(raw))
+            if self.decoder.done:
+                if self.decoder.extra:
+                    self.persistent = False
+                self.release()
+        elif self.remaining is not None:
+            if len(raw) > self.remaining:
+                # more data than announced; don't trust this connection
+                raw = raw[:self.remaining]
+                self.persistent = False
+            self.readahead.extend(raw)
+            self.remaining = self.remaining - len(raw)
+            if self.remaining == 0:
+                self.release()
+        else:
+            self.readahead.extend(raw)
+
+    def fill(self, maxbytes):
+        """Read from the socket once; may block."""
+        if self.remaining is not None:
+            maxbytes = min(maxbytes, self.remaining)
+        buf = self.recvbuf
+        if len(buf) < maxbytes:
+            buf = self.recvbuf = bytearray(maxbytes)
+        n = self.h.sock.recv_into(buf, maxbytes)
+        if n:
+            self.frame(memoryview(buf)[:n])
+        else:
+            # a chunked or counted body cut short is just as final
+            self.persistent = False
+            self.release()
 
     def getmeta(self):
+        if self.state == CONNECT or self.state == WAIT and self.has_socket:
+            self.connect_now()
         assert self.state == META
         if not self.reply:
             x, y = self.pollmeta(None)
@@ -184,23 +686,105 @@ class http_access:
         assert self.state == DATA
         if self.readahead:
             return "processing readahead data", True
-        return ("waiting for data",
-                bool(select.select([self], [], [], 0)[0]))
+        if not self.h:
+            return "end of response", True
+        ready = bool(select.select([self], [], [], 0)[0])
+        if ready and self.decoder:
+            # the data read may be nothing but chunk framing
+            self.fill(8192)
+            ready = bool(self.readahead) or not self.h
+        return "waiting for data", ready
 
     def getdata(self, maxbytes):
         assert self.state == DATA
-        if self.readahead:
-            data = self.readahead[:maxbytes]
-            self.readahead = self.readahead[maxbytes:]
-            return data
-        data = self.h.sock.recv(maxbytes)
-        if not data:
+        while not self.readahead and self.h:
+            self.fill(maxbytes)
+        if not self.readahead:
             self.state = DONE
-            # self.close()
+            return b''
+        data = bytes(self.readahead[:maxbytes])
+        del self.readahead[:maxbytes]
+        if self.readahead or not self.h:
+            self.notify_reader()
         return data
 
     def fileno(self):
-        return self.h.sock.fileno()
+        if self.h and self.h.sock:
+            return self.h.sock.fileno()
+        return -1
+
+
+def test():
+    """Fetch a URL without a port from a local server.
+
+    The connection class is given the server's port as its default,
+    so the URL goes through the same lookup and connect as one for
+    port 80 would.  For other URLs, use ProtocolAPI.test().
+    """
+    import http.server
+    import threading
+    from ..grailbase import utils
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = self.path.encode('latin-1')
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    class Connection(http.client.HTTPConnection):
+        default_port = server.server_address[1]
+
+    class test_access(http_access):
+        connection_class = Connection
+
+    class Sockets:
+        max = 4
+        open = 0
+
+        def request_socket(self, requestor, callback, host=None,
+                           priority=None):
+            callback()
+
+        def return_socket(self, owner):
+            pass
+
+    class App:
+        root = tkinter.Tcl()
+        sq = Sockets()
+
+    app, utils._grail_app = utils._grail_app, App()
+    try:
+        api = test_access('//127.0.0.1/no-port', 'GET', {})
+        while not api.pollmeta()[1]:
+            App.root.dooneevent()
+        errcode, errmsg, headers = api.getmeta()
+        assert errcode == 200, (errcode, errmsg)
+        data = b''
+        while True:
+            chunk = api.getdata(512)
+            if not chunk:
+                break
+            data = data + chunk
+        assert data == b'/no-port', data
+        api.close()
+        App.root.update()               # let it recycle the connection
+        print("fetched", api.address, "->", errcode, data)
+    finally:
+        utils._grail_app = app
+        connection_pool.close()         # the server waits on it otherwise
+        server.shutdown()
+        server.server_close()
 
 
-# To test this, use ProtocolAPI.test()
+if __name__ == '__main__':
+    test()
@@ -7,11 +7,44 @@ from . import SGMLLexer
 import functools
 
 
+# Tag dispatch tables shared by all parsers, keyed by the value of the
+# handler's get_taginfo_key() method; each maps tag -> TagInfo or None.
+_taginfo_tables = {}
+
+
+def get_taginfo_table(handler):
+    """Return the tag dispatch table to use with a handler."""
+    key = handler.get_taginfo_key()
+    if key is None:
+        return {}
+    table = _taginfo_tables.get(key)
+    if table is None:
+        table = _taginfo_tables[key] = {}
+    return table
+
+
+def flush_taginfo_tables():
+    """Forget all shared dispatch tables.
+
+    This must be called whenever the result of get_taginfo() may
+    change, e.g. when tag extensions are added.
+    """
+    _taginfo_tables.clear()
+
+
 class ElementHandler:
 
     def close(self):
         pass
 
+    def get_taginfo_key(self):
+        """Return a key for sharing get_taginfo() results, or None.
+
+        All handlers returning the same key must resolve every tag the
+        same way; by default, tags are looked up on the class.
+        """
+        return type(self)
+
     def get_taginfo(self, tag):
         klass = type(self)
         start = getattr(klass, "start_" + tag, None)
@@ -137,6 +170,10 @@ class CompositeHandler:
     def close(self):
         self.__secondary.close()
 
+    def get_taginfo_key(self):
+        # get_taginfo() records which gatherer handles each tag
+        return None
+
     def get_taginfo(self, tag):
         taginfo = self.__secondary.get_taginfo(tag)
         if taginfo:
@@ -36,12 +36,27 @@ whitespace = '\\t\\n\x0b\x0c\\r '
 # and CDATA (character data -- only end tags are special).
 
 import re
+from sys import intern
 
 
 class SGMLError(Exception):
     pass
 
 
+# Token kinds produced by SGMLLexer.tokenize().  Each token is a tuple
+# (kind, end, a, b), where 'end' is the offset just past the token:
+#
+#   T_DATA      a = data string
+#   T_START     a = tag name, b = tuple of (name, value) attributes
+#   T_EMPTY     as T_START; an XML-style empty tag like <hr/>
+#   T_END       a = tag name
+#   T_COMMENT   a = comment string
+#   T_ENTITY    a = entity name, b = terminator
+#   T_CHARREF   a = character ordinal, b = terminator
+
+T_DATA, T_START, T_EMPTY, T_END, T_COMMENT, T_ENTITY, T_CHARREF = range(7)
+
+
 # SGML lexer base class -- find tags and call handler functions.
 # Usage: p = SGMLLexer(); p.feed(text); ...; p.close().
 # The data between tags is passed to the parser by calling
@@ -223,6 +238,11 @@ class SGMLLexer(SGMLLexerBase):
     _in_parse = False
     _finish_parse = False
 
+    # When at least this much data is waiting, tokenize it in batches
+    # of this size and replay the tokens, rather than scanning
+    # construct by construct.
+    batch_size = 32 * 1024
+
     def __init__(self):
         self.reset()
 
@@ -235,6 +255,11 @@ class SGMLLexer(SGMLLexerBase):
     rawdata = ''
 
     def reset(self):
+        self._chunks = []
+        self._waitfor = None
+        self._waittail = ''
+        self._resume = None
+        self._tokencache = {}
         self.stack = []
         self.lasttag = '???'
         self.nomoretags = False
@@ -253,7 +278,21 @@ class SGMLLexer(SGMLLexerBase):
         return None
 
     def feed(self, data):
-        self.rawdata = self.rawdata + data
+        if self._waitfor is not None:
+            # An unterminated construct is pending; only look at the
+            # new data (and the tail of the old data that could start
+            # a terminator) until it can possibly be completed.
+            pattern, partial = self._waitfor
+            window = self._waittail + data
+            if not pattern.search(window):
+                self._chunks.append(data)
+                if partial is not None:
+                    match = partial.search(window)
+                    self._waittail = window[match.start():] if match else ''
+                return
+            self._waitfor = None
+            self._waittail = ''
+        self._chunks.append(data)
         if not self._in_parse:
             self._in_parse = True
             self.goahead(False)
@@ -264,6 +303,7 @@ class SGMLLexer(SGMLLexerBase):
     def normalize(self, norm):
         prev = self._normfunc is str.lower
         self._normfunc = str.lower if norm else (lambda s: s)
+        self._tokencache = {}
         return prev
 
     def restrict(self, constrain):
@@ -272,26 +312,55 @@ class SGMLLexer(SGMLLexerBase):
         return prev
 
     def setliteral(self, tag):
+        import re
         self.literal = True
-        re = "{}{}[{}]*{}".format(ETAGO, tag, whitespace, TAGC)
-        if self._normfunc is str.lower:
-            self._lit_etag_re = re.compile(re, re.IGNORECASE)
-        else:
-            self._lit_etag_re = re.compile(re)
+        pattern = "{}{}[{}]*{}".format(ETAGO, tag, whitespace, TAGC)
+        # matches the start of the end tag at the end of the buffer
+        prefixes = [tag[:k] for k in range(len(tag) - 1, 0, -1)]
+        partial = "<(?:/(?:{}[{}]*|{}))?\\Z".format(
+            tag, whitespace, "|".join(prefixes + [""]))
+        flags = re.IGNORECASE if self._normfunc is str.lower else 0
+        self._lit_etag_re = re.compile(pattern, flags)
+        self._lit_partial_re = re.compile(partial, flags)
 
     def setnomoretags(self):
         self.nomoretags = True
 
+    # Internal -- move data passed to feed() into self.rawdata.
+    def _collect(self):
+        if self._chunks:
+            self._chunks.insert(0, self.rawdata)
+            self.rawdata = ''.join(self._chunks)
+            self._chunks = []
+            self._waitfor = None
+            self._waittail = ''
+
+    # Internal -- don't call goahead() again until data matching
+    # 'pattern' arrives.  'partial' matches the shortest tail of the
+    # buffered data that could be the start of such a match.
+    def _wait(self, pattern, partial=None, tail=''):
+        if not self._chunks:
+            self._waitfor = pattern, partial
+            self._waittail = tail
+
     # Internal -- handle data as far as reasonable.  May leave state
     # and data to be processed by a subsequent call.  If 'end' is
     # true, force handling all data as if followed by EOF marker.
     def goahead(self, end):
         #print("goahead", self.rawdata)
+        self._collect()
         i = 0
         n = len(self.rawdata)
         while i < n:
+            self._collect()
             rawdata = self.rawdata  # pick up any appended data
             n = len(rawdata)
+            if n - i >= self.batch_size and not (
+                    self.nomoretags or self.literal or self._strict):
+                tokens = self.tokenize(rawdata, i, i + self.batch_size)
+                if tokens:
+                    i = self.replay(tokens)
+                    continue
             if self.nomoretags:
                 self.lex_data(rawdata[i:n])
                 i = n
@@ -306,8 +375,10 @@ class SGMLLexer(SGMLLexerBase):
                     self.literal = False
                     continue
                 else:
-                    pos = rawdata.rfind("<", i)
-                    if pos >= 0:
+                    # keep only what could be the start of the end tag
+                    match = self._lit_partial_re.search(rawdata, i)
+                    pos = match.start() if match else n
+                    if i < pos:
                         self.lex_data(rawdata[i:pos])
                         i = pos
                 break
@@ -335,12 +406,14 @@ class SGMLLexer(SGMLLexerBase):
                     #print("parse_starttag", self.parse_starttag)
                     k = self.parse_starttag(i)
                     if k < 0:
+                        self._wait(endbracket)
                         break
                     i = k
                     continue
                 if endtagopen.match(rawdata, i):
                     k = self.parse_endtag(i)
                     if k < 0:
+                        self._wait(endbracket)
                         break
                     i = k
                     self.literal = False
@@ -450,7 +523,158 @@ class SGMLLexer(SGMLLexerBase):
         if (end or self._finish_parse) and i < n:
             self.lex_data(self.rawdata[i:n])
             i = n
-        self.rawdata = self.rawdata[i:]
+        if i:
+            self.rawdata = self.rawdata[i:]
+            if self._resume is not None:
+                start, pos = self._resume
+                if start >= i:
+                    self._resume = start - i, pos - i
+                else:
+                    self._resume = None
+
+    def tokenize(self, rawdata, i=0, stop=None):
+        """Split rawdata[i:stop] into a list of tokens in a single pass.
+
+        No handlers are called; see replay().  Only the non-strict,
+        non-literal syntax is understood.  Tokenizing stops at the
+        first construct that is incomplete or that needs the general
+        scanner in goahead() (the offset just past the last token
+        tells where).  The last token may extend past 'stop'.  Tags
+        and references are parsed once per distinct spelling.
+        """
+        tokens = []
+        append = tokens.append
+        cache = self._tokencache
+        match = batch_token.match
+        if stop is None:
+            stop = len(rawdata)
+        while i < stop:
+            m = match(rawdata, i)
+            if m is None:
+                break
+            if m.lastindex == 1:
+                i = m.end()
+                append((T_DATA, i, m.group(1), None))
+                continue
+            markup = m.group()
+            if markup.startswith(MDO):
+                i = self.tokenize_declaration(rawdata, i, append)
+                if i < 0:
+                    break
+                continue
+            try:
+                parsed = cache[markup]
+            except KeyError:
+                parsed = cache[markup] = self.tokenize_markup(markup)
+            if parsed is None:
+                break
+            for kind, end, a, b in parsed:
+                append((kind, i + end, a, b))
+            i = i + end
+        return tokens
+
+    # Internal -- tokenize a tag or reference.  'markup' runs up to
+    # the first '<' or '>' after the start of a tag, or one character
+    # past the name of a reference, which is always enough to decide
+    # what goahead() would do with it.  Returns a tuple of tokens with
+    # offsets relative to the markup, or None.
+    def tokenize_markup(self, markup):
+        m = batch_markup.match(markup)
+        if m is None:
+            return None
+        kind = m.lastgroup              # the group that closed last
+        j = m.end()
+        norm = self._normfunc
+        if kind == 'tagc':
+            attrs = []
+            for a in batch_attr.finditer(m.group('attrs')):
+                attrname, rest, value = a.group(1, 2, 3)
+                if not rest:
+                    value = None
+                elif value[:1] in (LIT, LITA):
+                    value = value[1:-1]
+                    if '&' in value:
+                        from .SGMLReplacer import replace
+                        value = replace(value, self.entitydefs)
+                attrs.append((intern(norm(attrname)), value))
+            tag = intern(norm(m.group('stag')))
+            tagc = m.group('tagc')
+            if tagc == '/>':
+                return (T_EMPTY, j, tag, tuple(attrs)),
+            if tagc == '<':
+                j = j - 1
+            return (T_START, j, tag, tuple(attrs)),
+        if kind == 'etagc':
+            if m.group('etagc') == '<':
+                j = j - 1
+            return (T_END, j, intern(norm(m.group('etag'))), None),
+        if kind == 'crterm':
+            ordinal = int(m.group('charref'))
+            terminator = m.group('crterm')
+            if terminator == '\n':
+                return (T_CHARREF, j - 1, ordinal, ''), (T_DATA, j, '\n', None)
+            if terminator != REFC:
+                return (T_CHARREF, j - 1, ordinal, ''),
+            return (T_CHARREF, j, ordinal, terminator),
+        if kind == 'erterm':
+            terminator = m.group('erterm')
+            if terminator not in ';\n':
+                j = j - 1
+                terminator = ''
+            return (T_ENTITY, j, m.group('entityref'), terminator),
+        if m.group() == '</>':
+            return (T_END, j, '', None),
+        return (T_DATA, j, m.group(), None),
+
+    # Internal -- tokenize the markup declaration at rawdata[i].
+    # Returns the offset just past it, or -1 if it is incomplete.
+    def tokenize_declaration(self, rawdata, i, append):
+        if rawdata.startswith(MDO + COM, i):
+            m = commentclose.search(rawdata, i + 4)
+            if m is None:
+                return -1
+            append((T_COMMENT, m.end(), rawdata[i + 4:m.start()], None))
+            return m.end()
+        m = special.match(rawdata, i)
+        if m is None:
+            return -1
+        # declarations are ignored in non-strict mode
+        return m.end()
+
+    def replay(self, tokens):
+        """Dispatch tokens from tokenize() to the lex_*() methods.
+
+        Returns the offset just past the last token dispatched.
+        Replaying stops early if a handler changes the scanning mode
+        (e.g. by calling setliteral()), since the remaining tokens
+        may no longer be valid.
+        """
+        mode = self._normfunc
+        end = 0
+        for kind, end, a, b in tokens:
+            if kind == T_DATA:
+                self.lex_data(a)
+                continue
+            if kind == T_START:
+                self.lex_starttag(a, dict(b))
+            elif kind == T_END:
+                self.lex_endtag(a)
+            elif kind == T_EMPTY:
+                self.lex_starttag(a, dict(b))
+                self.lex_endtag(a)
+            elif kind == T_COMMENT:
+                self.lex_comment(a)
+                continue
+            elif kind == T_ENTITY:
+                self.lex_entityref(a, b)
+                continue
+            else:
+                self.lex_charref(a, b)
+                continue
+            if self.literal or self.nomoretags or self._strict \
+               or self._normfunc is not mode:
+                break
+        return end
 
     # Internal -- parse comment, return length or -1 if not terminated
     def parse_comment(self, i, end):
@@ -482,9 +706,20 @@ class SGMLLexer(SGMLLexerBase):
             for comment in comments:
                 self.lex_comment(comment)
             return pos + len(MDC) - i
-        # not strict
-        match = commentclose.search(rawdata, i + 4)
+        # not strict; resume the search where the last call left off
+        pos = i + 4
+        if self._resume is not None:
+            start, resume = self._resume
+            self._resume = None
+            if start == i:
+                pos = max(pos, resume)
+        match = commentclose.search(rawdata, pos)
         if not match:
+            if not end:
+                match = commentpartial.search(rawdata, pos)
+                pos = match.start() if match else len(rawdata)
+                self._resume = i, pos
+                self._wait(commentclose, commentpartial, rawdata[pos:])
             if end:
                 j = rawdata.find(MDC, i)
                 if j >= 0:
@@ -717,6 +952,7 @@ md_name = re.compile('([^>{}\'"]+)'.format(whitespace)
 md_string = re.compile('("[^"]*"|\'[^\']*\')' + OPTIONAL_WHITESPACE)
 commentopen = re.compile(MDO + COM)
 commentclose = re.compile(COM + OPTIONAL_WHITESPACE + MDC)
+commentpartial = re.compile(r'(?:{}{}|-)\Z'.format(COM, OPTIONAL_WHITESPACE))
 tagfind = re.compile(r'[a-zA-Z][-_.a-zA-Z0-9]*')
 attrfind = re.compile(
     # comma is for compatibility
@@ -727,6 +963,31 @@ attrfind = re.compile(
     + r'|[\-~a-zA-Z0-9,./:+*%?!\(\)_#=]*))?')
 tagend = re.compile(OPTIONAL_WHITESPACE + r'[<>/]')
 
+# used by SGMLLexer.tokenize(); quoted attribute values may not contain
+# '<' or '>', and every repetition is forced to match as much as the
+# regular expressions above would, so any match agrees with goahead()
+ATTR_VALUE_CHARS = r'\-~a-zA-Z0-9,./:+*%?!\(\)_#='
+batch_attr = re.compile(
+    ('[{},]*([_a-zA-Z][-:.a-zA-Z_0-9]*)(?![-:.a-zA-Z_0-9])'.format(whitespace))
+    + r'(' + OPTIONAL_WHITESPACE + VI + OPTIONAL_WHITESPACE
+    + r'(?![{}])('.format(whitespace) + LITA + r"[^'<>]*" + LITA
+    + r'|' + LIT + r'[^"<>]*' + LIT
+    + r'|[{0}]*(?![{0}]))'.format(ATTR_VALUE_CHARS)
+    + r'|(?!' + OPTIONAL_WHITESPACE + VI + r'))')
+batch_token = re.compile(
+    r'([^<&]+)|(<[^<>]*[<>])|(&(?:\#[0-9]*|[a-zA-Z][-.a-zA-Z0-9]*)?[\s\S])')
+batch_markup = re.compile(
+    r'<(?P<stag>[a-zA-Z][-_.a-zA-Z0-9]*)(?![-_.a-zA-Z0-9])'
+    r'(?P<attrs>(?:' + batch_attr.pattern + r')*)'
+    + OPTIONAL_WHITESPACE + r'(?P<tagc>/>|[<>]|/(?=[^<>]*[<>]))'
+    r'|</(?P<etag>[a-zA-Z][-.a-zA-Z0-9]*)[^-.<>a-zA-Z0-9]?[^<>]*'
+    r'(?P<etagc>[<>])'
+    r'|&\#(?P<charref>[0-9]+)(?P<crterm>[^0-9])'
+    r'|&(?P<entityref>[a-zA-Z][-.a-zA-Z0-9]*)(?P<erterm>[^-.a-zA-Z0-9])'
+    # constructs passed on as data
+    r'|(?P<other></>|<>|<\?|</(?=[^<>a-zA-Z])|<(?=[^a-zA-Z!/?>])'
+    r'|&\#(?=[^0-9])|&(?=[^a-zA-Z\#]))')
+
 # used below in comment_match()
 comment_start = re.compile(COM + r'([^-]*)-(.|\n)')
 comment_segment = re.compile(r'([^-]*)-(.|\n)')
@@ -782,3 +1043,27 @@ def comment_match(rawdata, start):
         else:
             matchlength = matcher.start()
     return -1, ''
+
+
+def benchmark(chunksize=512):
+    """Time feeding a 5 MB page with a 1 MB inline script."""
+    import time
+    line = "  if (a < b && c > d) { s = '<b>' + t; }  // -- x\n"
+    script = "<script><!--\n{}// --></script>\n".format(
+        line * (2**20 // len(line)))
+    para = '<p class="x">Some &amp; text &lt; here<br>\n'
+    body = para * (2**21 // len(para))
+    page = "<html><body>{}{}{}</body></html>".format(body, script, body)
+    lexer = SGMLLexer()
+    t0 = time.time()
+    for i in range(0, len(page), chunksize):
+        lexer.feed(page[i:i + chunksize])
+    lexer.close()
+    t1 = time.time()
+    print("{} bytes in {}-byte chunks: {:.2f} seconds".format(
+        len(page), chunksize, t1 - t0))
+
+
+if __name__ == '__main__':
+    import sys
+    benchmark(*map(int, sys.argv[1:2]))
@@ -51,7 +51,7 @@ class SGMLParser(SGMLLexer.SGMLLexer):
 
     def push_handler(self, handler):
         self.__handler = handler
-        self.__taginfo = {}
+        self.__taginfo = SGMLHandler.get_taginfo_table(handler)
         self.set_data_handler(handler.handle_data)
 
     def get_depth(self):
@@ -145,9 +145,9 @@ class SGMLParser(SGMLLexer.SGMLLexer):
                 if not tag:
                     raise SGMLError(
                         'Cannot start the document with an empty tag.')
-        if tag in self.__taginfo:
+        try:
             taginfo = self.__taginfo[tag]
-        else:
+        except KeyError:
             taginfo = self.__handler.get_taginfo(tag)
             self.__taginfo[tag] = taginfo
         if not taginfo:
@@ -9,6 +9,12 @@ from . import SGMLHandler
 
 class TagExtensionLoader(grailbase_extloader.ExtensionLoader):
 
+    def add_directory(self, path):
+        added = grailbase_extloader.ExtensionLoader.add_directory(self, path)
+        if added:
+            SGMLHandler.flush_taginfo_tables()
+        return added
+
     def find(self, name):
         mod = self.find_module(name)
         taginfo = None
@@ -39,3 +45,4 @@ class TagExtensionLoader(grailbase_extloader.ExtensionLoader):
             if start or do:
                 taginfo = SGMLHandler.TagInfo(tag, start, do, end)
                 self.add_extension(tag, taginfo)
+        SGMLHandler.flush_taginfo_tables()
@@ -0,0 +1,100 @@
+"""Asynchronous host name lookups with a cache.
+
+socket.getaddrinfo() blocks until the name server answers, which
+would freeze every browser window. Lookups are therefore run on a
+small pool of worker threads; the main thread asks for the result
+with resolve() until it is available. The worker threads only call
+getaddrinfo(); the cache itself is only touched by the main thread.
+
+getaddrinfo() does not report the TTL of the DNS records, so answers
+are kept for a fixed TTL seconds and failures for NEGATIVE_TTL
+seconds.
+"""
+
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+TTL = 300.0
+NEGATIVE_TTL = 30.0
+WORKERS = 4
+
+_cache = {}                             # (host, port) -> (expires, result)
+_pending = {}                           # (host, port) -> Future
+_executor = None
+
+
+def _lookup(host, port):
+    return socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+
+
+def _store(key, lookup):
+    try:
+        result = lookup()
+    except OSError as err:
+        _cache[key] = (time.time() + NEGATIVE_TTL, err)
+        raise
+    _cache[key] = (time.time() + TTL, result)
+    return result
+
+
+def _cached(key):
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    expires, result = entry
+    if expires < time.time():
+        del _cache[key]
+        return None
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def resolve(host, port):
+    """Return the getaddrinfo() list for (host, port), or None.
+
+    None means the lookup is still in progress; it is started in the
+    background if necessary. A failed lookup raises its OSError.
+    """
+    global _executor
+    key = host.lower(), port
+    result = _cached(key)
+    if result is not None:
+        return result
+    future = _pending.get(key)
+    if future is None:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(WORKERS)
+        _pending[key] = _executor.submit(_lookup, host, port)
+        return None
+    if not future.done():
+        return None
+    del _pending[key]
+    return _store(key, future.result)
+
+
+def resolve_now(host, port):
+    """Like resolve(), but wait for the answer."""
+    key = host.lower(), port
+    result = _cached(key)
+    if result is not None:
+        return result
+    future = _pending.pop(key, None)
+    if future is not None:
+        return _store(key, future.result)
+    return _store(key, lambda: _lookup(host, port))
+
+
+def gethostbyname(host):
+    """Cached, blocking replacement for socket.gethostbyname()."""
+    for family, type, proto, canonname, sockaddr in resolve_now(host, None):
+        if family == socket.AF_INET:
+            return sockaddr[0]
+    return socket.gethostbyname(host)
+
+
+def flush():
+    """Forget all cached answers."""
+    _cache.clear()